@@ -1,11 +1,29 @@
+import asyncio
+import logging
+import re
+import time
+from collections import Counter
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import error as tg_error
 
 from basic_handlers import handle_delete_callback
 from helpers import format_numeric
-from kinopoiskapiunofficial import KinopoiskApi
 from queries import (add_all_episodes_from_kp_serial,
                      add_episode_from_kp_episode, get_kp_episodes_by_serial_id,
-                     ignore_kp_episode, insert_kp_serial)
+                     ignore_kp_episode, insert_kp_serial, insert_kp_serials,
+                     rebuild_serial_popularity, rebuild_view_history_groups,
+                     rebuild_watched_episodes)
+from rate_limiter import PRIORITY_BULK
+
+# Seconds between edits of the import progress message
+IMPORT_PROGRESS_INTERVAL = 3
+
+REBUILDERS = {
+    'history': rebuild_view_history_groups,
+    'rating': rebuild_serial_popularity,
+    'watched': rebuild_watched_episodes,
+}
 
 
 async def handle_add_command(update, context):
@@ -18,8 +36,9 @@ async def handle_add_command(update, context):
 async def handle_get_command(update, context):
     '''
     Get information from kinopoisk.ru and store it in database.
+    Cached responses are used unless refresh is given.
     Usage format:
-    /get <kinopoisk-ID>
+    /get <kinopoisk-ID> [refresh]
     '''
     args = context.args
     kp_id = args and args[0].isdigit() and int(args[0])
@@ -27,26 +46,227 @@ async def handle_get_command(update, context):
         await update.effective_chat.send_message(
             'Укажите номер сериала в kinopoisk.ru')
         return
-    api = KinopoiskApi(context.application.parameters.get('kp_api_key'))
-    serial = await api.get_by_id(kp_id)
+    force_refresh = len(args) > 1 and args[1] == 'refresh'
+    serial, episodes = await context.application.kinopoisk \
+        .get_with_seasons(kp_id, force_refresh)
     if not serial:
         await update.effective_chat.send_message(
             'Сериал в kinopoisk.ru не найден')
         return
-    episodes = await api.get_seasons_info(kp_id)
-    with context.application.database.session() as db:
-        insert_kp_serial(db, serial, episodes)
+    counts = await context.application.database.run(
+        insert_kp_serial, serial, episodes)
     await update.effective_chat.send_message(
         f'Обновлена информация о фильме/сериале "{serial['nameRu']}."'
+        f'Эпизоды: новых {counts['inserted']}, изменено {counts['updated']}, '
+        f'без изменений {counts['unchanged']}.\n'
         f'Вы можете добавить этот объект в наш бот командой /add {kp_id}',
     )
 
 
+async def handle_import_command(update, context):
+    '''
+    Import many serials from kinopoisk.ru in the background.
+    Usage format:
+    /import <kinopoisk-ID> [<kinopoisk-ID> ...]
+    or a text file of IDs sent with the caption /import
+    '''
+    text = ' '.join(context.args or [])
+    document = update.message.document
+    if document:
+        file = await document.get_file()
+        text = (await file.download_as_bytearray()).decode(errors='ignore')
+    kp_ids = list(dict.fromkeys(int(kp_id) for kp_id
+                                in re.findall(r'\d+', text)))
+    if not kp_ids:
+        await update.effective_chat.send_message(
+            'Укажите номера сериалов в kinopoisk.ru или пришлите текстовый '
+            'файл с ними и подписью /import')
+        return
+    # Long imports must not hold up updates of other users
+    context.application.create_task(
+        import_kp_serials(update, context, kp_ids), update=update)
+
+
+async def import_kp_serials(update, context, kp_ids):
+    """
+    Загружает сериалы из kinopoisk.ru не более чем по
+    kp_import_concurrency одновременно и сохраняет их пачками по
+    kp_import_batch_size. Ход импорта показывается в одном сообщении.
+    """
+    application = context.application
+    semaphore = asyncio.Semaphore(
+        application.parameters['kp_import_concurrency'])
+    batch_size = application.parameters['kp_import_batch_size']
+    progress = {'total': len(kp_ids), 'done': 0, 'saved': 0, 'errors': [],
+                'episodes': Counter(inserted=0, updated=0, unchanged=0),
+                'started_at': time.monotonic()}
+    message = await update.effective_chat.send_message(
+        format_import_progress(progress),
+        rate_limit_args={'priority': PRIORITY_BULK})
+
+    async def fetch(kp_id):
+        async with semaphore:
+            try:
+                return kp_id, await application.kinopoisk \
+                    .get_with_seasons(kp_id), None
+            except Exception as e:
+                return kp_id, None, e
+
+    batch = []
+    edited_at = time.monotonic()
+    for task in asyncio.as_completed([fetch(kp_id) for kp_id in kp_ids]):
+        kp_id, result, error = await task
+        progress['done'] += 1
+        if error:
+            progress['errors'].append(f'{kp_id}: {error!r}')
+        else:
+            batch.append((kp_id, result))
+        if len(batch) >= batch_size or progress['done'] == len(kp_ids):
+            await save_kp_serials(application.database, batch, progress)
+            batch = []
+        if time.monotonic() - edited_at >= IMPORT_PROGRESS_INTERVAL:
+            edited_at = time.monotonic()
+            await edit_import_progress(message, progress)
+    await edit_import_progress(message, progress, finished=True)
+
+
+async def save_kp_serials(database, batch, progress):
+    if not batch:
+        return
+    try:
+        progress['episodes'].update(await database.run(
+            insert_kp_serials, [result for _, result in batch]))
+        progress['saved'] += len(batch)
+        return
+    except Exception:
+        logging.exception('Ошибка при сохранении пачки сериалов')
+    # Save one by one to find the serials that break the batch
+    for kp_id, (serial, episodes) in batch:
+        try:
+            progress['episodes'].update(await database.run(
+                insert_kp_serial, serial, episodes))
+            progress['saved'] += 1
+        except Exception as e:
+            progress['errors'].append(f'{kp_id}: {e!r}')
+
+
+async def edit_import_progress(message, progress, finished=False):
+    try:
+        await message.edit_text(format_import_progress(progress, finished),
+                                rate_limit_args={'priority': PRIORITY_BULK})
+    except tg_error.BadRequest as e:
+        # E.g. the progress message was deleted, the import goes on
+        if 'not modified' not in str(e):
+            logging.warning(f'Не удалось обновить прогресс импорта: {e}')
+
+
+def format_import_progress(progress, finished=False):
+    elapsed = time.monotonic() - progress['started_at']
+    speed = progress['done'] / elapsed if elapsed else 0
+    left = (progress['total'] - progress['done']) / speed if speed else 0
+    lines = [
+        f'Импорт из kinopoisk.ru {"завершен" if finished else "идет"}: '
+        f'{progress["done"]} из {progress["total"]}',
+        f'Сохранено: {progress["saved"]}, ошибок: {len(progress["errors"])}',
+        'Эпизоды: новых {inserted}, изменено {updated}, без изменений '
+        '{unchanged}'.format(**progress['episodes']),
+        f'Скорость: {speed:.1f} в секунду, прошло {elapsed:.0f} с'
+        + (f', осталось ~{left:.0f} с' if speed and not finished else ''),
+    ]
+    if progress['errors']:
+        lines.append('Последние ошибки:')
+        # Error texts can be long, the message is limited to 4096 chars
+        lines.extend(error[:200] for error in progress['errors'][-10:])
+    return '\n'.join(lines)
+
+
+async def handle_queries_command(update, context):
+    '''
+    Show SQL statements with the most total time since start or reset.
+    Usage format:
+    /queries [<count>|reset]
+    '''
+    profiler = context.application.database.profiler
+    if context.args and context.args[0] == 'reset':
+        profiler.reset()
+        await update.effective_chat.send_message(
+            'Статистика запросов сброшена')
+        return
+    limit = int(context.args[0]) if context.args and \
+        context.args[0].isdigit() else 10
+    queries = profiler.top(limit)
+    if not queries:
+        await update.effective_chat.send_message('Запросов еще не было')
+        return
+    lines = []
+    for number, query in enumerate(queries, 1):
+        lines.append(
+            f'{number}. {query.total_time:.3f}с, {query.count} раз, '
+            f'ср. {query.total_time / query.count * 1000:.1f}мс, '
+            f'макс. {query.max_time * 1000:.1f}мс\n{query.statement[:300]}')
+    # Messages are limited to 4096 characters
+    await update.effective_chat.send_message('\n\n'.join(lines)[:4096])
+
+
+async def handle_rebuild_command(update, context):
+    '''
+    Rebuild aggregate tables from the episode view records.
+    Usage format:
+    /rebuild <history|rating|watched>
+    '''
+    target = context.args and context.args[0]
+    if target not in REBUILDERS:
+        await update.effective_chat.send_message(
+            f'Укажите что пересчитать: {", ".join(REBUILDERS)}')
+        return
+    application = context.application
+    # Incremental updates of the writer would race the full recount
+    async with application.view_record_writer.paused():
+        rows = await application.database.run(REBUILDERS[target])
+    await update.effective_chat.send_message(
+        f'Пересчет {target} завершен, записей: {rows}')
+
+
+async def handle_stats_command(update, context):
+    '''
+    Show cache hit/miss, view record queue and Bot API queue statistics.
+    Usage format:
+    /stats
+    '''
+    lines = [
+        'Кэш {}: {size} из {maxsize}, попаданий {hits}, промахов {misses} '
+        '({hit_ratio:.0%}), вытеснено {evictions}'.format(name, **stats)
+        for name, stats in context.application.catalog_cache.stats().items()
+    ]
+    lines.append(
+        'Запись просмотров: в очереди {queue_depth}, записано '
+        '{flushed_records} за {flushes} пачек, ошибок {failed_flushes}, '
+        'отброшено {dropped_records}, '
+        'задержка {avg_flush_latency:.3f}с (макс. {max_flush_latency:.3f}с)'
+        .format(**context.application.view_record_writer.stats())
+    )
+    lines.append(
+        'Запросы к Bot API: в очереди {queue_depth} '
+        '(макс. {max_queue_depth}), выполняется {in_flight}, всего '
+        '{requests}, повторов после '
+        'RetryAfter {retries}, ожидание {avg_wait:.3f}с'
+        .format(**context.bot.rate_limiter.stats())
+    )
+    kinopoisk_cache = context.application.kinopoisk.cache
+    if kinopoisk_cache:
+        lines.append(
+            'Кэш Kinopoisk: попаданий {hits}, промахов {misses} '
+            '({hit_ratio:.0%}), подтверждено без загрузки {revalidations}'
+            .format(**kinopoisk_cache.stats())
+        )
+    await update.effective_chat.send_message('\n'.join(lines))
+
+
 async def handle_exclude_callback(update, context):
     callback_query = update.callback_query
     _, kp_episode, page = callback_query.data.split('_')
-    with context.application.database.session() as db:
-        serial = ignore_kp_episode(db, kp_episode)
+    serial = await context.application.database.run(
+        ignore_kp_episode, kp_episode)
     context.args = [str(serial.id), page, ]
     await handle_update_command(update, context)
     await handle_delete_callback(update, context)
@@ -55,15 +275,17 @@ async def handle_exclude_callback(update, context):
 async def handle_include_callback(update, context):
     callback_query = update.callback_query
     _, kp_episode, arg = callback_query.data.split('_')
-    with context.application.database.session() as db:
-        if kp_episode == 'all':
-            add_all_episodes_from_kp_serial(db, arg)
-            await update.effective_chat.send_message(
-                f'Все эпизоды сериала с ID {arg} добавлены в базу данных')
-        else:
-            serial = add_episode_from_kp_episode(db, kp_episode)
-            context.args = [str(serial.id), arg, ]
-            await handle_update_command(update, context)
+    database = context.application.database
+    if kp_episode == 'all':
+        episode_ids = await database.run(add_all_episodes_from_kp_serial, arg)
+        added = format_numeric(len(episode_ids), 'эпизод')
+        await update.effective_chat.send_message(
+            f'Все эпизоды сериала с ID {arg} добавлены в базу данных '
+            f'({added})')
+    else:
+        episode = await database.run(add_episode_from_kp_episode, kp_episode)
+        context.args = [str(episode.serial_id), arg, ]
+        await handle_update_command(update, context)
     await handle_delete_callback(update, context)
 
 
@@ -89,18 +311,19 @@ async def handle_update_command(update, context):
     current_page = args and args[1].isdigit() and int(args[1]) or 1
     page_length = context.application.parameters.get('page_length')
     offset = (current_page - 1) * page_length
-    with context.application.database.session() as db:
-        kp_episodes = get_kp_episodes_by_serial_id(db, serial_id)
+    kp_episodes, total_count, current_page = await context.application \
+        .database.run(get_kp_episodes_by_serial_id, serial_id, page_length,
+                      offset)
     if not kp_episodes:
         await update.effective_chat.send_message(
             f'Сериал с ID {serial_id} не найден, либо для него неизвестны '
             'новые эпизоды')
         return
 
-    total_pages = len(kp_episodes) // page_length
-    total_pages += 1 if len(kp_episodes) % page_length else 0
+    total_pages = total_count // page_length
+    total_pages += 1 if total_count % page_length else 0
     keyboard = []
-    for episode in kp_episodes[offset:offset+page_length]:
+    for episode in kp_episodes:
         name = f'{episode.name_rus} ({episode.name_eng})' \
             if episode.name_rus else episode.name_eng
         keyboard.append(
@@ -141,7 +364,7 @@ async def handle_update_command(update, context):
             InlineKeyboardButton(text='❌ Удалить меню',
                                  callback_data='delete_'),
     ])
-    text = f'Можем добавить {format_numeric(len(kp_episodes), 'эпизод')}\n'
+    text = f'Можем добавить {format_numeric(total_count, 'эпизод')}\n'
     await update.effective_chat.send_message(
         text,
         reply_markup=InlineKeyboardMarkup(keyboard),
@@ -1,3 +1,5 @@
+import asyncio
+import functools
 import html
 import json
 import logging
@@ -9,7 +11,9 @@ from telegram.ext import (Application, CallbackQueryHandler, CommandHandler,
                           ConversationHandler, MessageHandler, filters)
 
 from admin import (handle_add_command, handle_exclude_callback,
-                   handle_get_command, handle_include_callback,
+                   handle_get_command, handle_import_command,
+                   handle_include_callback, handle_queries_command,
+                   handle_rebuild_command, handle_stats_command,
                    handle_update_callback, handle_update_command)
 from basic_handlers import (handle_alphabet_callback, handle_alphabet_command,
                             handle_delete_callback, handle_details_callback,
@@ -22,8 +26,18 @@ from basic_handlers import (handle_alphabet_callback, handle_alphabet_command,
                             handle_serial_command, handle_start_command,
                             handle_text_callback, handle_unknown_callback,
                             handle_urls)
+from cache import CatalogCache
+from catalog import SerialCatalog
 from config import Config
 from db import Database
+from instrumentation import (InstrumentedApplication, InstrumentedRequest,
+                             collect_application_metrics)
+from kinopoisk_cache import KinopoiskCache
+from kinopoiskapiunofficial import KinopoiskApi
+from metrics import REGISTRY, start_metrics_server
+from rate_limiter import PRIORITY_BULK, FloodControlRateLimiter
+from update_processor import PerChatUpdateProcessor
+from write_behind import ViewRecordWriter
 
 BASIC_MODE, = range(1)
 
@@ -62,7 +76,8 @@ async def error_handler(update, context):
         await context.bot.send_message(
             chat_id=chat_id,
             text=message,
-            parse_mode=ParseMode.HTML)
+            parse_mode=ParseMode.HTML,
+            rate_limit_args={'priority': PRIORITY_BULK})
 
 
 async def log_update(update: Update, _):
@@ -76,13 +91,48 @@ async def log_update(update: Update, _):
         logger.info(f"🔘 Callback data: {update.callback_query.data}")
 
 
-def main():
-    """Run the bot."""
-    app_config = Config()
-    logging.getLogger().setLevel(
-        logging.DEBUG if app_config.parameters['debug'] else logging.INFO
+async def post_init(application):
+    application.view_record_writer.start()
+    await application.catalog.refresh(application.database)
+    application.catalog_refresh_task = asyncio.create_task(
+        application.catalog.refresh_periodically(
+            application.database,
+            application.parameters['catalog_refresh_interval'],
+        )
     )
+    REGISTRY.add_collector(
+        functools.partial(collect_application_metrics, application))
+    application.metrics_server = None
+    if application.metrics_port:
+        try:
+            application.metrics_server = await start_metrics_server(
+                application.metrics_host, application.metrics_port)
+        except OSError:
+            # Metrics are optional, the bot works without them
+            logging.exception('Не удалось запустить сервер метрик')
+
+
+async def post_stop(application):
+    application.catalog_refresh_task.cancel()
+    if application.metrics_server:
+        application.metrics_server.close()
+    try:
+        await application.view_record_writer.close()
+    except Exception:
+        # post_shutdown still has to close the database and the API client
+        logging.exception('Не удалось записать историю просмотров')
+
 
+async def post_shutdown(application):
+    await application.kinopoisk.aclose()
+    application.database.close()
+
+
+def build_application(app_config):
+    """
+    Build the bot application with its handlers, database and services
+    from the configuration, without starting it.
+    """
     conversation_handler = ConversationHandler(
         entry_points=[
             CommandHandler('start', handle_start_command),
@@ -102,6 +152,22 @@ def main():
             CommandHandler(
                 'update', handle_update_command,
                 filters.Chat(app_config.parameters.get('storage_chat_id')),),
+            CommandHandler(
+                'import', handle_import_command,
+                filters.Chat(app_config.parameters.get('storage_chat_id')),),
+            MessageHandler(
+                filters.Document.TXT & filters.CaptionRegex(r'^/import')
+                & filters.Chat(app_config.parameters.get('storage_chat_id')),
+                handle_import_command),
+            CommandHandler(
+                'queries', handle_queries_command,
+                filters.Chat(app_config.parameters.get('storage_chat_id')),),
+            CommandHandler(
+                'rebuild', handle_rebuild_command,
+                filters.Chat(app_config.parameters.get('storage_chat_id')),),
+            CommandHandler(
+                'stats', handle_stats_command,
+                filters.Chat(app_config.parameters.get('storage_chat_id')),),
             MessageHandler(
                 filters.TEXT & (~filters.COMMAND) &
                 (filters.Entity("url") | filters.Entity("text_link")),
@@ -135,18 +201,74 @@ def main():
     # persistence = PicklePersistence(filepath='persistence.pickle')
     # Для включения добавить в инициализацию    .persistence(persistence)
     application = Application.builder() \
+        .application_class(InstrumentedApplication) \
         .token(app_config.tg_bot_token) \
         .base_url(app_config.tg_base_url) \
+        .request(InstrumentedRequest(connection_pool_size=256)) \
+        .rate_limiter(FloodControlRateLimiter(
+            global_rate=app_config.parameters['rate_limit_global'],
+            chat_rate=app_config.parameters['rate_limit_chat'],
+            group_rate=app_config.parameters['rate_limit_group'] / 60,
+            max_retries=app_config.parameters['rate_limit_max_retries'],
+        )) \
+        .concurrent_updates(PerChatUpdateProcessor(
+            app_config.parameters['concurrent_updates'])) \
+        .post_init(post_init) \
+        .post_stop(post_stop) \
+        .post_shutdown(post_shutdown) \
         .build()
 
-    application.database = Database(app_config.db_url, )
+    application.database = Database(
+        app_config.db_url,
+        pool_size=app_config.db_pool_size,
+        slow_query_threshold=app_config.db_slow_query_threshold / 1000,
+        explain_sample_rate=app_config.db_explain_sample_rate,
+        n_plus_one_threshold=app_config.db_n_plus_one_threshold,
+    )
     application.parameters = app_config.parameters
+    application.metrics_host = app_config.metrics_host
+    application.metrics_port = app_config.metrics_port
+    application.catalog = SerialCatalog()
+    application.catalog_cache = CatalogCache(
+        application.database,
+        app_config.parameters['catalog_cache_size'],
+        app_config.parameters['catalog_cache_ttl'],
+    )
+    application.kinopoisk = KinopoiskApi(
+        app_config.parameters['kp_api_key'],
+        base_url=app_config.parameters['kp_api_url'],
+        http2=app_config.parameters['kp_http2'],
+        rate_limit=app_config.parameters['kp_rate_limit'],
+        max_retries=app_config.parameters['kp_max_retries'],
+        max_retry_after=app_config.parameters['kp_max_retry_after'],
+        cache=KinopoiskCache(
+            app_config.parameters['kp_cache_path'],
+            app_config.parameters['kp_cache_ttls'],
+        ) if app_config.parameters['kp_cache_path'] else None,
+    )
+    application.view_record_writer = ViewRecordWriter(
+        application.database,
+        app_config.parameters['view_records_batch_size'],
+        app_config.parameters['view_records_flush_interval'] / 1000,
+        app_config.parameters['view_records_max_retries'],
+        app_config.parameters['view_records_max_queue_size'],
+    )
 
     application.add_handler(MessageHandler(filters.ALL, log_update), group=-1)
     application.add_handler(CallbackQueryHandler(log_update), group=-1)
 
     application.add_handler(conversation_handler)
     application.add_error_handler(error_handler)
+    return application
+
+
+def main():
+    """Run the bot."""
+    app_config = Config()
+    logging.getLogger().setLevel(
+        logging.DEBUG if app_config.parameters['debug'] else logging.INFO
+    )
+    application = build_application(app_config)
 
     if app_config.tg_webhook_port and app_config.tg_webhook_url:
         application.run_webhook(
@@ -2,21 +2,19 @@ import logging
 import re
 
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
+from telegram import InputMediaPhoto, Message
 from telegram import error as tg_error
 
-from helpers import get_search_text
+from helpers import decode_cursor, get_search_text
 from messages import (format_alphabet_message, format_details_message,
                       format_episodes_message, format_help_message,
                       format_history_message, format_play_message,
                       format_random_serials_message, format_rating_message,
                       format_search_message, format_seasons_message)
 from queries import (create_new_movie_request, get_aggregated_view_history,
-                     get_alphabet_counts, get_episode_by_id,
-                     get_episodes_by_serial_and_season, get_next_episode,
-                     get_random_serials, get_seasons_by_serial_id,
-                     get_serial_by_id, get_serial_by_search_key,
-                     get_serials_by_namepart, get_serials_rating,
-                     insert_episode_view_record, insert_new_user)
+                     get_episodes_by_serial_and_season,
+                     get_serial_by_search_key, get_serials_rating,
+                     insert_new_user)
 
 
 async def handle_alphabet_callback(update, context):
@@ -24,16 +22,14 @@ async def handle_alphabet_callback(update, context):
     _, language = callback_query.data.split('_')
     context.args = [language,]
     await handle_alphabet_command(update, context)
-    await handle_delete_callback(update, context)
 
 
 async def handle_alphabet_command(update, context):
     is_english = context.args and context.args[0].lower().startswith('en')
     language = 'ENG' if is_english else 'RUS'
-    with context.application.database.session() as db:
-        letters = get_alphabet_counts(db, language)
+    letters = context.application.catalog.alphabet_counts(language)
     text, markup = format_alphabet_message(letters)
-    await update.effective_chat.send_message(text=text, reply_markup=markup, )
+    await send_or_edit_message(update, context, text, markup)
 
 
 async def handle_delete_callback(update, context):
@@ -51,7 +47,6 @@ async def handle_details_callback(update, context):
     _, serial_id = callback_query.data.split('_')
     context.args = [serial_id,]
     await handle_details_command(update, context)
-    await handle_delete_callback(update, context)
 
 
 async def handle_details_command(update, context):
@@ -59,16 +54,15 @@ async def handle_details_command(update, context):
     if not serial_id:
         await handle_help_command(update, context)
         return
-    with context.application.database.session() as db:
-        try:
-            serial = get_serial_by_id(db, serial_id)
-        except (NoResultFound, MultipleResultsFound) as e:
-            await update.effective_chat.send_message(
-                f'Ошибка {e} при загрузке сериала {serial_id}')
-            raise
+    try:
+        serial = await context.application.catalog_cache.get_serial(serial_id)
+    except (NoResultFound, MultipleResultsFound) as e:
+        await update.effective_chat.send_message(
+            f'Ошибка {e} при загрузке сериала {serial_id}')
+        raise
     text, markup = format_details_message(serial)
-    await update.effective_chat.send_message(
-        text=text, parse_mode='HTML', reply_markup=markup, )
+    await send_or_edit_message(update, context, text, markup,
+                               parse_mode='HTML')
 
 
 async def handle_episodes_callback(update, context):
@@ -77,25 +71,21 @@ async def handle_episodes_callback(update, context):
     current_page = int(page)
     page_length = context.application.parameters.get('page_length')
     user_id = update.effective_sender.id
-    with context.application.database.session() as db:
-        try:
-            serial = get_serial_by_id(db, serial_id)
-            episodes, total_lines, current_page = get_episodes_by_serial_and_season( # noqa E501
-                db, serial_id, season, user_id, page_length,
-                (current_page - 1) * page_length
-            )
-        except (NoResultFound, MultipleResultsFound) as e:
-            await callback_query.answer(f'Ошибка {e} при загрузке сериала {serial_id}') # noqa E501
-            raise
+    application = context.application
+    try:
+        serial = await application.catalog_cache.get_serial(serial_id)
+        episodes, total_lines, current_page = await application.database.run(
+            get_episodes_by_serial_and_season,
+            serial_id, season, user_id, page_length,
+            (current_page - 1) * page_length
+        )
+    except (NoResultFound, MultipleResultsFound) as e:
+        await callback_query.answer(f'Ошибка {e} при загрузке сериала {serial_id}') # noqa E501
+        raise
     text, markup = format_episodes_message(
         serial, season, episodes, total_lines, current_page, page_length)
-    await update.effective_chat.send_photo(
-        photo=serial.file_id,
-        parse_mode='HTML',
-        caption=text,
-        reply_markup=markup,
-    )
-    await handle_delete_callback(update, context)
+    await send_or_edit_message(update, context, text, markup,
+                               photo=serial.file_id, parse_mode='HTML')
 
 
 async def handle_help_command(update, context):
@@ -105,41 +95,43 @@ async def handle_help_command(update, context):
 
 async def handle_history_callback(update, context):
     callback_query = update.callback_query
-    _, page = callback_query.data.split('_')
-    context.args = [int(page),]
+    _, page, *cursor = callback_query.data.split('_')
+    context.args = [int(page), *cursor]
     await handle_history_command(update, context)
-    await handle_delete_callback(update, context)
 
 
 async def handle_history_command(update, context):
     user_id = update.effective_sender.id
     page = int(context.args[0]) if context.args else 1
+    cursor = decode_cursor(context.args[1], 1) \
+        if len(context.args) > 1 else None
     page_length = context.application.parameters.get('page_length')
-    offset = (page - 1) * page_length
-    with context.application.database.session() as db:
-        history, num_lines = get_aggregated_view_history(
-            db, user_id, page_length, offset)
+    history, num_lines, page_keys = await context.application.database.run(
+        get_aggregated_view_history, user_id, page_length, page, cursor)
     if not history:
         text = 'История просмотров пуста'
-        await update.effective_chat.send_message(text=text)
+        await send_or_edit_message(update, context, text)
         return
     text, markup = format_history_message(history, num_lines, page,
-                                          page_length, )
-    await update.effective_chat.send_message(text=text, reply_markup=markup, )
+                                          page_length, page_keys)
+    await send_or_edit_message(update, context, text, markup)
 
 
 async def handle_play_callback(update, context):
     callback_query = update.callback_query
     _, episode_id, file_id = callback_query.data.split('_')
-    with context.application.database.session() as db:
-        try:
-            files = get_episode_by_id(db, episode_id)
-            next_episode = get_next_episode(db, files[0])
-        except (NoResultFound, MultipleResultsFound) as e:
-            await callback_query.answer(
-                f'Ошибка {e} при загрузке сериала {episode_id}')
-            raise
-        insert_episode_view_record(db, update.effective_sender.id, episode_id)
+    application = context.application
+    try:
+        payload = await application.catalog_cache.get_play_payload(episode_id)
+    except (NoResultFound, MultipleResultsFound) as e:
+        await callback_query.answer(
+            f'Ошибка {e} при загрузке сериала {episode_id}')
+        raise
+    if payload is None:
+        await callback_query.answer(f'Эпизод {episode_id} не найден')
+        return
+    files, next_episode = payload
+    application.view_record_writer.add(update.effective_sender.id, episode_id)
     text, markup, current_file = format_play_message(
         context.bot.username, files, int(file_id), next_episode, )
     kwargs = {'parse_mode': 'HTML', 'caption': text, 'reply_markup': markup, }
@@ -150,23 +142,22 @@ async def handle_play_callback(update, context):
 
 async def handle_rating_callback(update, context):
     callback_query = update.callback_query
-    _, page = callback_query.data.split('_')
-    context.args = [int(page),]
+    _, page, *cursor = callback_query.data.split('_')
+    context.args = [int(page), *cursor]
     await handle_rating_command(update, context)
-    await handle_delete_callback(update, context)
 
 
 async def handle_rating_command(update, context):
     page = int(context.args[0]) if context.args else 1
+    cursor = decode_cursor(context.args[1], 2) \
+        if len(context.args) > 1 else None
     page_length = context.application.parameters.get('page_length')
-    with context.application.database.session() as db:
-        serials, num_lines = get_serials_rating(db, page_length, page)
-    text, markup = format_rating_message(serials, num_lines, page, page_length)
-    await update.effective_chat.send_message(
-        parse_mode='HTML',
-        text=text,
-        reply_markup=markup,
-    )
+    serials, num_lines, page_keys = await context.application.database.run(
+        get_serials_rating, page_length, page, cursor)
+    text, markup = format_rating_message(serials, num_lines, page, page_length,
+                                         page_keys)
+    await send_or_edit_message(update, context, text, markup,
+                               parse_mode='HTML')
 
 
 async def handle_search_callback(update, context):
@@ -184,8 +175,6 @@ async def handle_search_callback(update, context):
         return
     context.args = [search_text, page]
     await handle_search_command(update, context)
-    await handle_delete_callback(update, context)
-    return
 
 
 async def handle_search_command(update, context):
@@ -196,25 +185,21 @@ async def handle_search_command(update, context):
     search_text = context.args.pop(0)
     page = context.args.pop(0) if context.args else 1
     page_length = context.application.parameters.get('page_length')
-    namepart = f'%{search_text}%' if len(search_text) > 2 else f'{search_text}%' # noqa E501
-    with context.application.database.session() as db:
-        serials, num_lines = get_serials_by_namepart(
-            db, namepart, page_length, page)
-        if not serials:
-            await update.effective_chat.send_message(
-                'По вашему запросу ничего не найдено в нашем каталоге. '
-                'Попробуйте найти сериал на kinopoisk.ru или imdb.com и '
-                'пришлите нам ссылку на его страницу. Мы постараемся '
-                'добавить его при наличии технической возможности.'
-            )
-            return
-        text, markup = format_search_message(
-            search_text, serials, num_lines, page, page_length)
-    await update.effective_chat.send_message(
-        parse_mode='HTML',
-        text=text,
-        reply_markup=markup,
-    )
+    serials, num_lines = context.application.catalog.search(
+        search_text, page_length, page)
+    if not serials:
+        await send_or_edit_message(
+            update, context,
+            'По вашему запросу ничего не найдено в нашем каталоге. '
+            'Попробуйте найти сериал на kinopoisk.ru или imdb.com и '
+            'пришлите нам ссылку на его страницу. Мы постараемся '
+            'добавить его при наличии технической возможности.'
+        )
+        return
+    text, markup = format_search_message(
+        search_text, serials, num_lines, page, page_length)
+    await send_or_edit_message(update, context, text, markup,
+                               parse_mode='HTML')
 
 
 async def handle_search_text(update, context):
@@ -227,34 +212,28 @@ async def handle_search_text(update, context):
 async def handle_seasons_callback(update, context):
     callback_query = update.callback_query
     _, serial_id = callback_query.data.split('_')
-    with context.application.database.session() as db:
-        try:
-            serial = get_serial_by_id(db, serial_id)
-            seasons = get_seasons_by_serial_id(db, serial_id)
-        except (NoResultFound, MultipleResultsFound) as e:
-            await callback_query.answer(
-                f'Ошибка {e} при загрузке сериала {serial_id}')
-            raise
+    catalog_cache = context.application.catalog_cache
+    try:
+        serial = await catalog_cache.get_serial(serial_id)
+        seasons = await catalog_cache.get_seasons(serial_id)
+    except (NoResultFound, MultipleResultsFound) as e:
+        await callback_query.answer(
+            f'Ошибка {e} при загрузке сериала {serial_id}')
+        raise
     text, markup = format_seasons_message(serial, seasons)
-    await update.effective_chat.send_photo(
-        photo=serial.file_id,
-        parse_mode='HTML',
-        caption=text,
-        reply_markup=markup,
-    )
-    await handle_delete_callback(update, context)
+    await send_or_edit_message(update, context, text, markup,
+                               photo=serial.file_id, parse_mode='HTML')
 
 
 async def handle_serial_command(update, context):
-    with context.application.database.session() as db:
-        serials = get_random_serials(db, )
+    serials = context.application.catalog.sample()
     text, markup = format_random_serials_message(serials)
     await update.effective_chat.send_message(text=text, reply_markup=markup, )
 
 
 async def handle_start_command(update, context):
-    with context.application.database.session() as db:
-        insert_new_user(db, update.effective_sender)
+    await context.application.database.run(
+        insert_new_user, update.effective_sender)
     if not context.args:
         await handle_help_command(update, context)
         return
@@ -267,7 +246,6 @@ async def handle_text_callback(update, context):
     page = 1
     context.args = [search_text, page]
     await handle_search_command(update, context)
-    await handle_delete_callback(update, context)
 
 
 async def handle_unknown_callback(update, context):
@@ -286,20 +264,78 @@ async def handle_urls(update, context):
         return
     search_key = 'imdb' if search.group(1) == 'imdb.com' else 'kp_id'
     search_value = search.group(2)
-    with context.application.database.session() as db:
-        try:
-            serial = get_serial_by_search_key(db, search_key, search_value)
-        except NoResultFound:
-            user_id = update.effective_sender.id
-            create_new_movie_request(db, user_id, update.message.text,
-                                     **{search_key: search_value})
-            web_url = re.sub(r'(imdb\.com|kinopoisk\.ru)', 'kinospisok.ru',
-                             update.message.text)
-            await update.effective_chat.send_message(
-                'В нашем каталоге такого контента пока нет.\n'
-                'Пока мы работаем над его добавлением, попробуйте посмотреть '
-                f'его на этом ресурсе: {web_url}')
-            return
+    database = context.application.database
+    try:
+        serial = await database.run(
+            get_serial_by_search_key, search_key, search_value)
+    except NoResultFound:
+        user_id = update.effective_sender.id
+        await database.run(create_new_movie_request, user_id,
+                           update.message.text, **{search_key: search_value})
+        web_url = re.sub(r'(imdb\.com|kinopoisk\.ru)', 'kinospisok.ru',
+                         update.message.text)
+        await update.effective_chat.send_message(
+            'В нашем каталоге такого контента пока нет.\n'
+            'Пока мы работаем над его добавлением, попробуйте посмотреть '
+            f'его на этом ресурсе: {web_url}')
+        return
     text, markup = format_details_message(serial)
     await update.effective_chat.send_message(
         text=text, parse_mode='HTML', reply_markup=markup, )
+
+
+async def send_or_edit_message(update, context, text, reply_markup=None,
+                               photo=None, parse_mode=None):
+    """
+    Показывает экран навигации. Для нажатой кнопки сообщение редактируется
+    на месте, если это возможно, иначе отправляется новое сообщение,
+    а старое удаляется.
+    """
+    callback_query = update.callback_query
+    message = callback_query.message if callback_query else None
+    if isinstance(message, Message) and \
+            context.application.parameters.get('edit_in_place'):
+        try:
+            edited = await edit_message(callback_query, message, text,
+                                        reply_markup, photo, parse_mode)
+        except tg_error.BadRequest as e:
+            if 'not modified' not in str(e):
+                logging.warning(f'Edit: {e}')
+                edited = False
+            else:
+                edited = True
+        if edited:
+            await callback_query.answer()
+            return
+    if photo:
+        await update.effective_chat.send_photo(
+            photo=photo, caption=text, parse_mode=parse_mode,
+            reply_markup=reply_markup, )
+    else:
+        await update.effective_chat.send_message(
+            text=text, parse_mode=parse_mode, reply_markup=reply_markup, )
+    if callback_query:
+        await handle_delete_callback(update, context)
+
+
+async def edit_message(callback_query, message, text, reply_markup, photo,
+                       parse_mode):
+    """
+    Заменяет содержимое сообщения. Текстовое сообщение нельзя превратить
+    в фото и наоборот, в этом случае возвращает False.
+    """
+    if photo and message.photo and message.photo[-1].file_id == photo:
+        # Постер тот же, клиенту не нужно загружать его заново
+        await callback_query.edit_message_caption(
+            caption=text, parse_mode=parse_mode, reply_markup=reply_markup)
+    elif photo and (message.photo or message.video or message.animation
+                    or message.document):
+        await callback_query.edit_message_media(
+            InputMediaPhoto(photo, caption=text, parse_mode=parse_mode),
+            reply_markup=reply_markup)
+    elif not photo and message.text is not None:
+        await callback_query.edit_message_text(
+            text=text, parse_mode=parse_mode, reply_markup=reply_markup)
+    else:
+        return False
+    return True
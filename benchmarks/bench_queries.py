@@ -0,0 +1,483 @@
+"""
+Benchmark of the queries.py functions, the SerialCatalog search and the
+CatalogCache next episode lookup on a database filled by
+benchmarks.generate.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_queries --db-url sqlite:///bench.db \\
+        --output results.json [--baseline baseline.json]
+
+Every function runs against the same seeded arguments, write functions in
+a transaction that is rolled back. Results are written as JSON with the
+run time statistics of every case in milliseconds. With --baseline the
+medians are compared to a previous result and the exit status is 1 if a
+case got slower than the allowed ratio.
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import logging
+import platform
+import random
+import statistics
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func
+
+import queries
+from cache import CatalogCache
+from catalog import SerialCatalog, normalize_name
+from db import Database
+from models import (Episode, EpisodeViewRecord, KPEpisode, KPSerial,
+                    RequestedNewMovie, Serial, SerialPopularity, User,
+                    ViewHistoryGroup)
+
+# Helpers measured as part of their callers
+HELPERS = {'mark_serial_changed', 'get_keyset_page', 'get_keyset_condition',
+           'get_bit', 'set_bit', 'get_set_bits',
+           'get_missing_kp_episode_conditions', 'get_viewer_ranges',
+           'mark_episode_changed', 'get_unfilled_aggregates'}
+# Rebuild the aggregate tables from all view records, run with --rebuild
+REBUILDS = {'rebuild_view_history_groups', 'rebuild_serial_popularity',
+            'rebuild_watched_episodes'}
+
+# cleanup(db, result, *args) reverts what a committing function did
+Case = namedtuple('Case', ['name', 'function', 'get_args', 'write',
+                           'cleanup'], defaults=[None])
+# Telegram user passed to insert_new_user
+TelegramUser = namedtuple('TelegramUser', ['id', 'username', 'first_name',
+                                           'last_name', 'language_code',
+                                           'is_bot'])
+
+
+class Fixtures:
+    """
+    Seeded random arguments drawn from the generated data.
+    """
+    def __init__(self, db, seed):
+        self.rnd = random.Random(seed)
+        self.serial_ids = [row.id for row in db.query(Serial.id)]
+        self.user_ids = [row.id for row in db.query(User.id)]
+        self.max_episode_id = db.query(func.max(Episode.id)).scalar()
+        self.max_group_id = db.query(func.max(ViewHistoryGroup.id)).scalar()
+        self.kp_serial_ids = [row.kp_id for row in db.query(KPSerial.kp_id)]
+        self.max_kp_episode_id = db.query(func.max(KPEpisode.id)).scalar()
+        # Kinopoisk episodes the catalog does not have yet
+        self.missing_kp_episodes = db.query(
+            KPEpisode.id, Serial.id.label('serial_id'),
+        ).join(
+            Serial, Serial.kp_id == func.cast(KPEpisode.kp_serial_id,
+                                              Serial.kp_id.type),
+        ).outerjoin(Episode, and_(
+            Episode.serial_id == Serial.id,
+            Episode.season == KPEpisode.season,
+            Episode.episode == KPEpisode.episode,
+        )).filter(Episode.id.is_(None)).all()
+        self.db = db
+
+    def serial_id(self):
+        return self.rnd.choice(self.serial_ids)
+
+    def user_id(self):
+        return self.rnd.choice(self.user_ids)
+
+    def episode(self):
+        return self.db.get(Episode, self.rnd.randint(1, self.max_episode_id))
+
+    def history_group(self):
+        return self.db.get(ViewHistoryGroup,
+                           self.rnd.randint(1, self.max_group_id))
+
+    def season(self, serial_id):
+        seasons = queries.get_seasons_by_serial_id(self.db, serial_id)
+        return self.rnd.choice(seasons).season
+
+    def rating_key(self):
+        total = self.db.query(func.count(SerialPopularity.serial_id)).scalar()
+        row = self.db.query(SerialPopularity) \
+            .order_by(SerialPopularity.users.desc(),
+                      SerialPopularity.serial_id.desc()) \
+            .offset(self.rnd.randrange(total)).first()
+        return row.users, row.serial_id
+
+    def view_records(self, count):
+        created_at = datetime(2030, 1, 1)
+        return [{
+            'user_id': self.user_id(),
+            'episode_id': self.rnd.randint(1, self.max_episode_id),
+            'created_at': (created_at + timedelta(seconds=number))
+            .strftime('%Y-%m-%d %H:%M:%S.%f'),
+        } for number in range(count)]
+
+    def kp_response(self, kp_id):
+        """
+        Kinopoisk API response for a known serial with a few renamed and
+        new episodes, as KinopoiskApi.get_with_seasons returns it.
+        """
+        kp_serial = self.db.get(KPSerial, kp_id)
+        seasons = {}
+        for episode in kp_serial.episodes:
+            name_rus = episode.name_rus
+            if self.rnd.random() < 0.1:
+                name_rus += ' (новое название)'
+            seasons.setdefault(episode.season, []).append({
+                'seasonNumber': episode.season,
+                'episodeNumber': episode.episode,
+                'nameRu': name_rus,
+                'nameEn': episode.name_eng,
+            })
+        new_season = max(seasons, default=0) + 1
+        seasons[new_season] = [{
+            'seasonNumber': new_season, 'episodeNumber': number,
+            'nameRu': f'Серия {number}', 'nameEn': f'Episode {number}',
+        } for number in range(1, 11)]
+        serial = {
+            'kinopoiskId': kp_id,
+            'nameRu': kp_serial.name_rus,
+            'nameOriginal': kp_serial.name_eng,
+            'nameEn': None,
+            'description': kp_serial.descr,
+            'posterUrlPreview': kp_serial.poster,
+            'imdbId': kp_serial.imdb,
+        }
+        return serial, {'items': [{'number': number, 'episodes': episodes}
+                                  for number, episodes in seasons.items()]}
+
+
+def get_cases(fixtures):
+    f = fixtures
+
+    def episodes_args(offset):
+        def get_args():
+            serial_id = f.serial_id()
+            return (serial_id, f.season(serial_id), f.user_id(), 10, offset)
+        return get_args
+
+    def history_cursor_args():
+        group = f.history_group()
+        return (group.user_id, 10, 1, ('next', (group.id, )))
+
+    def kp_serials_args():
+        return ([f.kp_response(kp_id) for kp_id in
+                 f.rnd.sample(f.kp_serial_ids, min(20, len(f.kp_serial_ids)))
+                 ], )
+
+    def new_user_args():
+        user_id = f.rnd.randint(10 ** 9, 2 * 10 ** 9)
+        return (TelegramUser(user_id, f'bench{user_id}', 'Bench', '', 'ru',
+                             False), )
+
+    def watched_args():
+        episodes = [f.episode() for _ in range(20)]
+        return ({(f.user_id(), episode.serial_id, episode.season,
+                  episode.episode) for episode in episodes}, )
+
+    return [
+        Case('get_aggregated_view_history',
+             queries.get_aggregated_view_history,
+             lambda: (f.history_group().user_id, 10, 1), False),
+        Case('get_aggregated_view_history[cursor]',
+             queries.get_aggregated_view_history, history_cursor_args, False),
+        Case('get_serial_by_id', queries.get_serial_by_id,
+             lambda: (f.serial_id(), ), False),
+        Case('get_serial_names', queries.get_serial_names, tuple, False),
+        Case('get_serial_by_search_key', queries.get_serial_by_search_key,
+             lambda: ('imdb', f'tt{f.serial_id():07d}'), False),
+        Case('get_seasons_by_serial_id', queries.get_seasons_by_serial_id,
+             lambda: (f.serial_id(), ), False),
+        Case('get_kp_episodes_by_serial_id',
+             queries.get_kp_episodes_by_serial_id,
+             lambda: (f.rnd.choice(f.missing_kp_episodes).serial_id, 10, 0),
+             False),
+        Case('get_episodes_by_serial_and_season',
+             queries.get_episodes_by_serial_and_season, episodes_args(0),
+             False),
+        Case('get_episodes_by_serial_and_season[first_unwatched]',
+             queries.get_episodes_by_serial_and_season, episodes_args(-1),
+             False),
+        Case('get_episode_by_id', queries.get_episode_by_id,
+             lambda: (f.rnd.randint(1, f.max_episode_id), ), False),
+        Case('get_episode_order', queries.get_episode_order,
+             lambda: (f.serial_id(), ), False),
+        Case('get_serials_rating', queries.get_serials_rating,
+             lambda: (10, 1), False),
+        Case('get_serials_rating[cursor]', queries.get_serials_rating,
+             lambda: (10, 1, ('next', f.rating_key())), False),
+        Case('get_serials_rating[last]', queries.get_serials_rating,
+             lambda: (10, 1, ('last', ())), False),
+
+        Case('insert_episode_view_record', queries.insert_episode_view_record,
+             lambda: (f.user_id(), f.rnd.randint(1, f.max_episode_id)), True),
+        Case('insert_episode_view_records[100]',
+             queries.insert_episode_view_records,
+             lambda: (f.view_records(100), ), True),
+        Case('update_serial_popularity', queries.update_serial_popularity,
+             lambda: ({(f.user_id(), f.serial_id()) for _ in range(20)}, ),
+             True),
+        Case('update_view_history_groups', queries.update_view_history_groups,
+             lambda: ([(record['user_id'], f.serial_id(),
+                        record['created_at'])
+                       for record in f.view_records(20)], ), True),
+        Case('update_watched_episodes', queries.update_watched_episodes,
+             watched_args, True),
+        Case('insert_kp_serial', queries.insert_kp_serial,
+             lambda: f.kp_response(f.rnd.choice(f.kp_serial_ids)), True),
+        Case('insert_kp_serials[20]', queries.insert_kp_serials,
+             kp_serials_args, True),
+        Case('add_all_episodes_from_kp_serial',
+             queries.add_all_episodes_from_kp_serial,
+             lambda: (f.rnd.choice(f.missing_kp_episodes).serial_id, ), True),
+        Case('add_episode_from_kp_episode',
+             queries.add_episode_from_kp_episode,
+             lambda: (f.rnd.choice(f.missing_kp_episodes).id, ), True),
+        Case('insert_new_episode', queries.insert_new_episode,
+             lambda: (f.serial_id(), 100, f.rnd.randint(1, 100), 'Серия'),
+             True),
+        Case('insert_new_user', queries.insert_new_user, new_user_args, True),
+    ]
+
+
+def get_catalog_cases(fixtures, database, loop):
+    """
+    Hot paths served from memory instead of queries.py: name search in
+    SerialCatalog and the next episode from CatalogCache, on a hit and on
+    a miss that loads the episode order. The session is not used.
+    """
+    f = fixtures
+    rows = queries.get_serial_names(f.db)
+    catalog = SerialCatalog()
+    catalog.sync(rows)
+    cache = CatalogCache(database)
+    names = [normalize_name(row.name_rus) for row in rows if row.name_rus]
+
+    def search(db, text):
+        return catalog.search(text)
+
+    def get_next_episode(db, episode):
+        return loop.run_until_complete(cache.get_next_episode(episode))
+
+    def search_args(length):
+        def get_args():
+            name = f.rnd.choice(names)
+            start = f.rnd.randrange(max(1, len(name) - length + 1))
+            return (name[start:start + length], )
+        return get_args
+
+    def next_episode_args(cached):
+        def get_args():
+            episode = f.episode()
+            if cached:
+                get_next_episode(None, episode)
+            else:
+                cache.episode_orders.invalidate(episode.serial_id)
+            return (episode, )
+        return get_args
+
+    return [
+        Case('SerialCatalog.search[1]', search, search_args(1), False),
+        Case('SerialCatalog.search[2]', search, search_args(2), False),
+        Case('SerialCatalog.search[5]', search, search_args(5), False),
+        Case('CatalogCache.get_next_episode[hit]', get_next_episode,
+             next_episode_args(True), False),
+        Case('CatalogCache.get_next_episode[miss]', get_next_episode,
+             next_episode_args(False), False),
+    ]
+
+
+def get_rebuild_cases():
+    return [Case(name, getattr(queries, name), tuple, True)
+            for name in sorted(REBUILDS)]
+
+
+def get_committing_cases(fixtures):
+    """
+    Functions that commit on their own. Their changes are reverted by
+    the cleanup after every run instead of rolled back.
+    """
+    f = fixtures
+
+    def reset_ignore(db, result, kp_episode_id):
+        db.query(KPEpisode).filter(KPEpisode.id == kp_episode_id) \
+            .update({KPEpisode.ignore: False})
+        db.commit()
+
+    def delete_request(db, request, user_id, url):
+        db.query(RequestedNewMovie) \
+            .filter(RequestedNewMovie.id == request.id).delete()
+        db.commit()
+
+    return [
+        Case('ignore_kp_episode', queries.ignore_kp_episode,
+             lambda: (f.rnd.randint(1, f.max_kp_episode_id), ), False,
+             reset_ignore),
+        Case('create_new_movie_request', queries.create_new_movie_request,
+             lambda: (f.user_id(), 'https://www.kinopoisk.ru/series/1/'),
+             False, delete_request),
+    ]
+
+
+def run_case(database, case, runs, warmup):
+    """
+    Returns:
+        list: run times in seconds, without the warmup runs
+    """
+    times = []
+    for number in range(warmup + runs):
+        session = database.SessionLocal()
+        try:
+            # Arguments are prepared in the same session outside of the
+            # measured call
+            args = case.get_args()
+            started = time.perf_counter()
+            result = case.function(session, *args)
+            if case.write:
+                session.flush()
+            elapsed = time.perf_counter() - started
+            if case.cleanup:
+                case.cleanup(session, result, *args)
+        finally:
+            session.rollback()
+            session.close()
+        if number >= warmup:
+            times.append(elapsed)
+    return times
+
+
+def summarize(times):
+    times = sorted(times)
+    milliseconds = [value * 1000 for value in times]
+    return {
+        'runs': len(times),
+        'min_ms': round(milliseconds[0], 3),
+        'median_ms': round(statistics.median(milliseconds), 3),
+        'p95_ms': round(milliseconds[min(len(times) - 1,
+                                         int(len(times) * 0.95))], 3),
+        'max_ms': round(milliseconds[-1], 3),
+        'mean_ms': round(statistics.fmean(milliseconds), 3),
+    }
+
+
+def compare(results, baseline, max_ratio, min_delta_ms):
+    """
+    Cases whose median grew more than max_ratio times and by more than
+    min_delta_ms, the second threshold ignores noise of fast queries.
+
+    Returns:
+        list: (name, baseline median, current median) of regressions
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous or 'median_ms' not in previous \
+                or 'median_ms' not in result:
+            continue
+        before, after = previous['median_ms'], result['median_ms']
+        if after > before * max_ratio and after - before > min_delta_ms:
+            regressions.append((name, before, after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--db-url', required=True,
+                        help='database filled by benchmarks.generate')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--filter', default='',
+                        help='run only cases whose name contains this text')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='also run the rebuild_* functions (slow)')
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--max-ratio', type=float, default=1.25,
+                        help='allowed median slowdown against the baseline')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0,
+                        help='slowdowns smaller than this are not regressions')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    # No slow query logging in the middle of the measurements
+    database = Database(args.db_url, slow_query_threshold=float('inf'))
+    db = database.SessionLocal()
+    loop = asyncio.new_event_loop()
+    try:
+        fixtures = Fixtures(db, args.seed)
+        cases = get_cases(fixtures) + get_committing_cases(fixtures) \
+            + get_catalog_cases(fixtures, database, loop)
+        if args.rebuild:
+            cases += get_rebuild_cases()
+
+        covered = {case.function.__name__ for case in cases} | HELPERS
+        if not args.rebuild:
+            covered |= REBUILDS
+        not_covered = sorted(
+            name for name, function
+            in inspect.getmembers(queries, inspect.isfunction)
+            if function.__module__ == queries.__name__ and name not in covered)
+        if not_covered:
+            logging.warning(f'Functions without a benchmark: {not_covered}')
+
+        results = {}
+        for case in cases:
+            if args.filter not in case.name:
+                continue
+            try:
+                results[case.name] = summarize(
+                    run_case(database, case, args.runs, args.warmup))
+            except Exception as e:
+                results[case.name] = {'error': repr(e)}
+            logging.info(f'{case.name}: {results[case.name]}')
+
+        report = {
+            'meta': {
+                'dialect': database.engine.dialect.name,
+                'server_version': '.'.join(
+                    str(part) for part in
+                    database.engine.dialect.server_version_info or ()),
+                'python': platform.python_version(),
+                'seed': args.seed,
+                'runs': args.runs,
+                'warmup': args.warmup,
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'rows': {
+                    model.__tablename__: db.query(func.count()).select_from(
+                        model).scalar()
+                    for model in (Serial, Episode, KPEpisode,
+                                  EpisodeViewRecord, ViewHistoryGroup, User)
+                },
+                'not_covered': not_covered,
+            },
+            'results': results,
+        }
+    finally:
+        loop.close()
+        db.close()
+        database.close()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.max_ratio,
+                              args.min_delta_ms)
+        for name, before, after in regressions:
+            logging.error(f'Regression {name}: median {before:.3f} ms -> '
+                          f'{after:.3f} ms ({after / before:.2f}x)')
+        if regressions:
+            sys.exit(1)
+        logging.info(f'No regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
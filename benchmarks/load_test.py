@@ -0,0 +1,457 @@
+"""
+End-to-end load test of one bot process without Telegram.
+
+Usage (from the repository root):
+    python -m benchmarks.load_test --db-url sqlite:///bench.db \\
+        --rates 10,20,50,100 --duration 30 [--output results.json]
+
+The application is built by app.build_application with the handlers of
+the bot and sends its Bot API requests to a stub server started in a
+separate process. Synthetic search, episodes, play and history updates
+are put into the update queue at each of the rates in turn, with
+exponentially distributed gaps. Every step reports the processed
+updates per second, the latency from the queue to the end of handling
+and the Bot API calls per update. A step whose throughput falls behind
+the offered rate or whose queue does not drain is past the saturation
+point.
+
+Play updates write view records, so run it on a copy of the database
+filled by benchmarks.generate.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from urllib.parse import parse_qs
+
+from sqlalchemy import func
+from telegram import Update
+
+from models import Episode, Serial, User
+
+# Weights of the update kinds, --mix overrides them
+DEFAULT_MIX = {'search': 3, 'episodes': 3, 'play': 3, 'history': 1}
+BOT_TOKEN = '123456:LOADTEST'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Load test',
+            'username': 'load_test_bot'}
+SAMPLE_SIZE = 5000
+
+
+def get_stub_result(method, body, message_ids):
+    method = method.lower()
+    if method == 'getme':
+        return BOT_USER
+    if not method.startswith(('send', 'edit')):
+        # answerCallbackQuery, deleteMessage, ...
+        return True
+    try:
+        chat_id = int(parse_qs(body.decode())['chat_id'][0])
+    except (KeyError, ValueError, UnicodeDecodeError):
+        # Multipart requests with files
+        chat_id = 0
+    return {
+        'message_id': next(message_ids),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': BOT_USER,
+    }
+
+
+async def serve_stub(host, port, latency, started):
+    """
+    Minimal Bot API: every method succeeds, send* and edit* return a
+    message. Keeps connections alive like api.telegram.org.
+    """
+    message_ids = iter(range(1, sys.maxsize))
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                length = 0
+                while (line := await reader.readline()) not in (
+                        b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'content-length':
+                        length = int(value)
+                body = await reader.readexactly(length) if length else b''
+                method = request_line.split()[1].split(b'?')[0] \
+                    .rsplit(b'/', 1)[-1].decode()
+                if latency:
+                    await asyncio.sleep(latency)
+                payload = json.dumps({
+                    'ok': True,
+                    'result': get_stub_result(method, body, message_ids),
+                }).encode()
+                writer.write(
+                    b'HTTP/1.1 200 OK\r\n'
+                    b'Content-Type: application/json\r\n'
+                    + f'Content-Length: {len(payload)}\r\n\r\n'.encode()
+                    + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port, backlog=1024)
+    started.put(server.sockets[0].getsockname()[1])
+    await server.serve_forever()
+
+
+def run_stub(host, port, latency, started):
+    asyncio.run(serve_stub(host, port, latency, started))
+
+
+class UpdateFactory:
+    """
+    Seeded synthetic updates of the users, serials and episodes of the
+    database.
+    """
+    def __init__(self, database, mix, users, seed):
+        self.rnd = random.Random(seed)
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.next_update_id = 1
+        with database.session() as db:
+            user_ids = [row.id for row in db.query(User.id)]
+            self.user_ids = self.rnd.sample(user_ids,
+                                            min(users, len(user_ids)))
+            self.seasons = defaultdict(list)
+            for row in db.query(Episode.serial_id, Episode.season).filter(
+                    Episode.file_id.is_not(None)).distinct():
+                self.seasons[row.serial_id].append(row.season)
+            self.serial_ids = sorted(self.seasons)
+            max_episode_id = db.query(func.max(Episode.id)).scalar()
+            self.episodes = db.query(Episode.id, Episode.file_id).filter(
+                Episode.id.in_(self.rnd.sample(
+                    range(1, max_episode_id + 1),
+                    min(SAMPLE_SIZE, max_episode_id))),
+                Episode.file_id.is_not(None),
+            ).all()
+            self.names = [row.name_rus for row in db.query(Serial.name_rus)
+                          .filter(Serial.id.in_(self.rnd.sample(
+                              self.serial_ids,
+                              min(SAMPLE_SIZE, len(self.serial_ids)))))]
+
+    def create(self):
+        """
+        Returns:
+            tuple: update kind and update dict in the Bot API format
+        """
+        kind = self.rnd.choices(self.kinds, self.weights)[0]
+        user_id = self.rnd.choice(self.user_ids)
+        if kind == 'search':
+            name = self.rnd.choice(self.names)
+            start = self.rnd.randrange(max(1, len(name) - 3))
+            update = self.message(user_id,
+                                  name[start:start + self.rnd.randint(3, 6)])
+        elif kind == 'history':
+            update = self.message(user_id, '/history')
+        elif kind == 'episodes':
+            serial_id = self.rnd.choice(self.serial_ids)
+            season = self.rnd.choice(self.seasons[serial_id])
+            # Page 0 opens the page with the first unwatched episode
+            update = self.callback(user_id, f'episodes_{serial_id}_{season}_0')
+        elif kind == 'play':
+            episode = self.rnd.choice(self.episodes)
+            update = self.callback(user_id,
+                                   f'play_{episode.id}_{episode.file_id}')
+        else:
+            raise ValueError(f'Unknown update kind {kind}')
+        return kind, update
+
+    def get_update_id(self):
+        self.next_update_id += 1
+        return self.next_update_id - 1
+
+    def message(self, user_id, text):
+        update_id = self.get_update_id()
+        message = {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                    'length': len(text.split()[0])}]
+        return {'update_id': update_id, 'message': message}
+
+    def callback(self, user_id, data):
+        """
+        Button pressed under a message with a serial poster
+        """
+        update_id = self.get_update_id()
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': BOT_USER,
+                'photo': [{'file_id': 'poster', 'file_unique_id': 'poster',
+                           'width': 320, 'height': 480}],
+                'caption': 'Сериал',
+            },
+        }}
+
+
+def percentile(values, share):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def summarize_latencies(values):
+    milliseconds = [value * 1000 for value in values]
+    return {
+        'p50_ms': round(percentile(milliseconds, 0.5) or 0, 2),
+        'p90_ms': round(percentile(milliseconds, 0.9) or 0, 2),
+        'p99_ms': round(percentile(milliseconds, 0.99) or 0, 2),
+        'max_ms': round(max(milliseconds, default=0), 2),
+    }
+
+
+async def run_step(application, factory, rate, duration, drain_timeout):
+    """
+    Put updates into the queue at `rate` per second for `duration`
+    seconds and wait for them to be processed.
+
+    Returns:
+        dict: throughput, latency and Bot API calls of the step
+    """
+    enqueued = {}
+    kinds = {}
+    results = []
+    errors = Counter()
+    done = asyncio.Event()
+    sending_finished = False
+
+    def on_update_processed(stats):
+        started_at = enqueued.pop(stats.update_id, None)
+        if started_at is None:
+            return
+        results.append((kinds.pop(stats.update_id),
+                        time.perf_counter() - started_at, stats))
+        if not enqueued and sending_finished:
+            done.set()
+
+    async def on_error(update, context):
+        errors[type(context.error).__name__] += 1
+
+    application.update_stats_callbacks.append(on_update_processed)
+    application.add_error_handler(on_error)
+    started_at = time.perf_counter()
+    next_at = started_at
+    try:
+        while next_at - started_at < duration:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind, data = factory.create()
+            update = Update.de_json(data, application.bot)
+            kinds[update.update_id] = kind
+            enqueued[update.update_id] = time.perf_counter()
+            application.update_queue.put_nowait(update)
+            next_at += factory.rnd.expovariate(rate)
+        sent_for = time.perf_counter() - started_at
+        sending_finished = True
+        if enqueued:
+            try:
+                await asyncio.wait_for(done.wait(), drain_timeout)
+            except asyncio.TimeoutError:
+                pass
+        finished_at = time.perf_counter()
+    finally:
+        application.update_stats_callbacks.remove(on_update_processed)
+        application.remove_error_handler(on_error)
+
+    processed = len(results)
+    sent = processed + len(enqueued)
+    api_calls = [stats.api_calls_total for _, _, stats in results]
+    by_kind = {}
+    for kind in factory.kinds:
+        kind_results = [result for result in results if result[0] == kind]
+        by_kind[kind] = {
+            'processed': len(kind_results),
+            **summarize_latencies(latency for _, latency, _ in kind_results),
+            'api_calls_per_update': round(
+                sum(stats.api_calls_total for _, _, stats in kind_results)
+                / len(kind_results), 2) if kind_results else None,
+        }
+    api_methods = Counter()
+    for _, _, stats in results:
+        api_methods.update(stats.api_calls)
+    return {
+        'offered_rate': rate,
+        'sent': sent,
+        'processed': processed,
+        'not_drained': len(enqueued),
+        'errors': dict(errors),
+        'sent_rate': round(sent / sent_for, 2),
+        'throughput': round(processed / (finished_at - started_at), 2),
+        **summarize_latencies(latency for _, latency, _ in results),
+        'handler_p50_ms': round(
+            (percentile([stats.duration for _, _, stats in results], 0.5)
+             or 0) * 1000, 2),
+        'api_calls_per_update': round(sum(api_calls) / processed, 2)
+        if processed else None,
+        'db_queries_per_update': round(
+            sum(stats.db_queries for _, _, stats in results) / processed, 2)
+        if processed else None,
+        'api_methods': dict(api_methods),
+        'by_kind': by_kind,
+    }
+
+
+async def run(args, stub_url):
+    from app import build_application
+    from config import Config
+
+    app_config = Config(override=False)
+    application = build_application(app_config)
+    logging.getLogger().setLevel(args.log_level)
+    factory = UpdateFactory(application.database, args.mix, args.users,
+                            args.seed)
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    steps = []
+    try:
+        for rate in args.rates:
+            logging.warning(f'Load test step: {rate} updates/s for '
+                            f'{args.duration}s against {stub_url}')
+            step = await run_step(application, factory, rate, args.duration,
+                                  args.drain_timeout)
+            steps.append(step)
+            print_step(step)
+            if step['not_drained']:
+                logging.warning('The queue did not drain, stopping')
+                break
+    finally:
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+    return steps
+
+
+def print_step(step):
+    print(f"{step['offered_rate']:>8} upd/s offered  "
+          f"{step['throughput']:>8} upd/s processed  "
+          f"p50 {step['p50_ms']:>8} ms  p99 {step['p99_ms']:>8} ms  "
+          f"API calls/update {step['api_calls_per_update']}  "
+          f"not drained {step['not_drained']}  errors {step['errors']}",
+          flush=True)
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f'Unknown update kind {kind}')
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--db-url', required=True,
+                        help='copy of a database filled by '
+                             'benchmarks.generate')
+    parser.add_argument('--rates', default='5,10,20,50,100',
+                        type=lambda text: [float(rate)
+                                           for rate in text.split(',')],
+                        help='offered updates per second of the steps')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds per step')
+    parser.add_argument('--drain-timeout', type=float, default=30,
+                        help='seconds to wait for the queue after a step')
+    parser.add_argument('--mix', type=parse_mix,
+                        default=','.join(f'{kind}={weight}' for kind, weight
+                                         in DEFAULT_MIX.items()),
+                        help='weights of the update kinds')
+    parser.add_argument('--users', type=int, default=1000,
+                        help='number of distinct users sending updates')
+    parser.add_argument('--api-latency', type=float, default=0,
+                        help='milliseconds the stub takes per Bot API call')
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help='keep the Telegram flood limits of the rate '
+                             'limiter, by default they are lifted')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING',
+                        help='INFO adds the per update logging of the bot')
+    parser.add_argument('--output', help='JSON file for the results')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(asctime)s %(message)s')
+
+    started = multiprocessing.Queue()
+    stub = multiprocessing.Process(
+        target=run_stub, args=('127.0.0.1', 0, args.api_latency / 1000,
+                               started), daemon=True)
+    stub.start()
+    stub_url = f'http://127.0.0.1:{started.get(timeout=10)}/bot'
+
+    # The configuration of the bot is read from the environment by Config
+    os.environ.update({
+        'DB_URL': args.db_url,
+        'TG_BOT_TOKEN': BOT_TOKEN,
+        'TG_API': stub_url,
+        'STORAGE_CHAT_ID': os.getenv('STORAGE_CHAT_ID', '-1'),
+        'METRICS_PORT': '0',
+        'KINOPOISK_CACHE_PATH': '',
+    })
+    if not args.telegram_limits:
+        os.environ.update({'RATE_LIMIT_GLOBAL': '1000000',
+                           'RATE_LIMIT_CHAT': '1000000'})
+
+    try:
+        steps = asyncio.run(run(args, stub_url))
+    finally:
+        stub.terminate()
+
+    report = {
+        'meta': {
+            'db_url': args.db_url.split('@')[-1],
+            'mix': args.mix,
+            'users': args.users,
+            'duration': args.duration,
+            'api_latency_ms': args.api_latency,
+            'telegram_limits': args.telegram_limits,
+            'seed': args.seed,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+        },
+        'steps': steps,
+    }
+    saturated = [step['offered_rate'] for step in steps
+                 if step['not_drained']
+                 or step['throughput'] < step['sent_rate'] * 0.95]
+    report['meta']['saturated_at'] = saturated[0] if saturated else None
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
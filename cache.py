@@ -0,0 +1,191 @@
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+
+from queries import (get_episode_by_id, get_episode_order,
+                     get_seasons_by_serial_id, get_serial_by_id)
+
+
+_MISSING = object()
+
+PlayPayload = namedtuple('PlayPayload', ['files', 'next_episode'])
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries also expire after `ttl` seconds.
+    Thread-safe, so entries may be invalidated from database worker threads.
+    Every invalidation bumps `generation`, so `fetch` can tell that a value
+    it loaded may predate the invalidation.
+    """
+    def __init__(self, maxsize=1024, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value, expires_at = self._data.get(key, (_MISSING, 0))
+            if value is _MISSING or expires_at < time.monotonic():
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        """
+        Cache value, unless `generation` is given and the cache has been
+        invalidated since.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._data.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        with self._lock:
+            self.generation += 1
+            for key in [key for key, (value, _) in self._data.items()
+                        if predicate(value)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    async def fetch(self, key, loader):
+        """
+        Read-through access: return the cached value or await loader() and
+        cache its result. None is not cached, so a row added later is found
+        by the next call. A result loaded while the cache was invalidated
+        is returned but not cached, it may be older than the invalidation.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            generation = self.generation
+            value = await loader()
+            if value is not None:
+                self.set(key, value, generation)
+        return value
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'size': len(self),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / requests if requests else 0.0,
+        }
+
+
+class CatalogCache:
+    """
+    Read-through cache for catalog rows shown by details, seasons,
+    episodes and play screens. Entries of a serial are dropped after a
+    commit that marked it as changed (see `queries.mark_serial_changed`),
+    play payloads of an episode after `queries.mark_episode_changed`.
+    Files uploaded outside of the bot show up when the entries expire.
+    """
+    def __init__(self, database, maxsize=1024, ttl=600):
+        self.database = database
+        self.serials = TTLCache(maxsize, ttl)
+        self.seasons = TTLCache(maxsize, ttl)
+        self.episode_orders = TTLCache(maxsize, ttl)
+        self.play_payloads = TTLCache(maxsize, ttl)
+        database.commit_hooks['changed_serials'].append(
+            self.invalidate_serials)
+        database.commit_hooks['changed_episodes'].append(
+            self.invalidate_episodes)
+
+    async def get_serial(self, serial_id):
+        serial_id = int(serial_id)
+        return await self.serials.fetch(
+            serial_id,
+            lambda: self.database.run(get_serial_by_id, serial_id),
+        )
+
+    async def get_seasons(self, serial_id):
+        serial_id = int(serial_id)
+        return await self.seasons.fetch(
+            serial_id,
+            lambda: self.database.run(get_seasons_by_serial_id, serial_id),
+        )
+
+    async def get_next_episode(self, current_episode):
+        """
+        Episode following current_episode (serial_id, season, episode) in
+        the order of `queries.get_episode_order`, or None for the last one.
+        """
+        serial_id = int(current_episode.serial_id)
+        keys, episodes = await self.episode_orders.fetch(
+            serial_id, lambda: self._load_episode_order(serial_id))
+        position = bisect_right(
+            keys, (current_episode.season, current_episode.episode))
+        return episodes[position] if position < len(episodes) else None
+
+    async def _load_episode_order(self, serial_id):
+        episodes = await self.database.run(get_episode_order, serial_id)
+        return [(row.season, row.episode) for row in episodes], episodes
+
+    async def get_play_payload(self, episode_id):
+        """
+        Everything needed to play an episode: rows of `get_episode_by_id`
+        (one per file) and the next episode, None for a missing episode.
+        """
+        episode_id = int(episode_id)
+        return await self.play_payloads.fetch(
+            episode_id, lambda: self._load_play_payload(episode_id))
+
+    async def _load_play_payload(self, episode_id):
+        files = await self.database.run(get_episode_by_id, episode_id)
+        if not files:
+            # None is not cached, see TTLCache.fetch
+            return None
+        next_episode = await self.get_next_episode(files[0])
+        return PlayPayload(tuple(files), next_episode)
+
+    def invalidate_episodes(self, episode_ids):
+        """
+        Drop play payloads after files of the episodes have changed.
+        """
+        for episode_id in episode_ids:
+            self.play_payloads.invalidate(episode_id)
+
+    def invalidate_serials(self, serial_ids):
+        for serial_id in serial_ids:
+            self.serials.invalidate(serial_id)
+            self.seasons.invalidate(serial_id)
+            self.episode_orders.invalidate(serial_id)
+        # New episodes may change the next episode of cached payloads
+        self.play_payloads.invalidate_where(
+            lambda payload: payload.files[0].serial_id in serial_ids)
+
+    def stats(self):
+        return {
+            'serials': self.serials.stats(),
+            'seasons': self.seasons.stats(),
+            'episodes': self.episode_orders.stats(),
+            'play': self.play_payloads.stats(),
+        }
@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import random
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict, namedtuple
+
+from queries import get_serial_names
+
+
+SerialName = namedtuple('SerialName', ['name_rus', 'name_eng', 'id'])
+Letter = namedtuple('Letter', ['letter', 'count'])
+
+NGRAM_LENGTH = 3
+BULK_SYNC_SIZE = 100
+
+
+def normalize_name(text):
+    return text.lower().replace('ё', 'е')
+
+
+def get_ngrams(text):
+    return {text[i:i+NGRAM_LENGTH]
+            for i in range(len(text) - NGRAM_LENGTH + 1)}
+
+
+class SerialCatalog:
+    """
+    In-memory index over names of the serials catalog.
+    Answers name searches, alphabet listings and draws random serials
+    without touching the database. Serials are not written by the bot,
+    so the index is loaded at startup and `refresh_periodically` re-reads
+    all names every interval. Only added, renamed and removed serials are
+    reindexed (see `sync`).
+    """
+    def __init__(self):
+        self._serials = {}
+        self._ngrams = defaultdict(set)
+        self._names = []
+        # Dense array of ids for uniform sampling, removal swaps in the last
+        self._ids = []
+        self._id_positions = {}
+        # First letter -> sorted (name, id), one entry per serial
+        self._letters = defaultdict(list)
+        self._letter_counts = {'RUS': Counter(), 'ENG': Counter()}
+
+    def __len__(self):
+        return len(self._serials)
+
+    def get(self, serial_id):
+        return self._serials.get(serial_id)
+
+    def sync(self, rows):
+        """
+        Bring the index in line with (id, name_rus, name_eng) rows of the
+        whole catalog. Only added, renamed and removed serials are
+        reindexed. Returns the number of such serials.
+        """
+        stale_ids = set(self._serials)
+        changed = []
+        for serial_id, name_rus, name_eng in rows:
+            stale_ids.discard(serial_id)
+            serial = SerialName(name_rus, name_eng, serial_id)
+            if self._serials.get(serial_id) != serial:
+                changed.append(serial)
+        # Sorting once is cheaper than many inserts into the sorted list
+        sort = len(changed) + len(stale_ids) <= BULK_SYNC_SIZE
+        for serial_id in stale_ids:
+            self._remove(serial_id, sort)
+        for serial in changed:
+            self._upsert(serial, sort)
+        if not sort:
+            self._names = sorted(
+                (name, serial.id)
+                for serial in self._serials.values()
+                for name in self._get_keys(serial)
+            )
+            self._letters = defaultdict(list)
+            for serial in self._serials.values():
+                for letter, name in self._get_letter_keys(serial).items():
+                    self._letters[letter].append((name, serial.id))
+            for letter_names in self._letters.values():
+                letter_names.sort()
+        return len(changed) + len(stale_ids)
+
+    async def refresh(self, database):
+        rows = await database.run(get_serial_names)
+        changes = self.sync(rows)
+        if changes:
+            logging.info(f'Каталог обновлен: {changes} изменений, '
+                         f'всего {len(self)} сериалов')
+
+    async def refresh_periodically(self, database, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh(database)
+            except Exception:
+                logging.exception('Ошибка при обновлении каталога')
+
+    def search(self, text, limit=10, page=1):
+        """
+        Find serials by part of the name.
+        Strings shorter than 3 letters match the start of the name, longer
+        ones match anywhere. Names starting with the text go first.
+
+        Returns:
+            tuple: list of SerialName for the page, total number of matches
+        """
+        text = normalize_name(text.strip('%'))
+        offset = limit * (int(page) - 1)
+        if not text:
+            return [], 0
+        if len(text) == 1:
+            letter_names = self._letters.get(text, [])
+            page_ids = [serial_id for _, serial_id
+                        in letter_names[offset:offset+limit]]
+            return [self._serials[serial_id] for serial_id in page_ids], \
+                len(letter_names)
+        if len(text) < NGRAM_LENGTH:
+            found_ids = self._search_prefix(text)
+        else:
+            found_ids = self._search_substring(text)
+        page_ids = found_ids[offset:offset+limit]
+        return [self._serials[serial_id] for serial_id in page_ids], \
+            len(found_ids)
+
+    def alphabet_counts(self, language):
+        """
+        Number of serials by the first letter of the name in `language`
+        (RUS or ENG).
+
+        Returns:
+            list: Letter sorted by letter
+        """
+        return [Letter(letter.upper(), count) for letter, count
+                in sorted(self._letter_counts[language].items())]
+
+    def sample(self, limit=10):
+        """
+        Random serials in O(limit) time.
+
+        Returns:
+            list: SerialName of up to `limit` distinct serials
+        """
+        serial_ids = random.sample(self._ids, min(limit, len(self._ids)))
+        return [self._serials[serial_id] for serial_id in serial_ids]
+
+    def _search_prefix(self, text):
+        found_ids = {}
+        position = bisect_left(self._names, (text, ))
+        for name, serial_id in self._names[position:]:
+            if not name.startswith(text):
+                break
+            found_ids.setdefault(serial_id)
+        return list(found_ids)
+
+    def _search_substring(self, text):
+        postings = sorted((self._ngrams.get(ngram, set())
+                           for ngram in get_ngrams(text)), key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        ranked = []
+        for serial_id in candidates:
+            # n-grams may match in a different order, so check the names
+            matches = [(name.find(text) > 0, name)
+                       for name in self._get_keys(self._serials[serial_id])
+                       if text in name]
+            if matches:
+                ranked.append((*min(matches), serial_id))
+        ranked.sort()
+        return [serial_id for _, _, serial_id in ranked]
+
+    def _upsert(self, serial, sort):
+        if self._serials.get(serial.id) == serial:
+            return
+        self._remove(serial.id, sort)
+        self._serials[serial.id] = serial
+        self._id_positions[serial.id] = len(self._ids)
+        self._ids.append(serial.id)
+        for language, name in self._get_language_keys(serial):
+            self._letter_counts[language][name[0]] += 1
+        if sort:
+            for letter, name in self._get_letter_keys(serial).items():
+                insort(self._letters[letter], (name, serial.id))
+        for name in self._get_keys(serial):
+            for ngram in get_ngrams(name):
+                self._ngrams[ngram].add(serial.id)
+            if sort:
+                insort(self._names, (name, serial.id))
+
+    def _remove(self, serial_id, sort):
+        serial = self._serials.pop(serial_id, None)
+        if not serial:
+            return
+        position = self._id_positions.pop(serial_id)
+        last_id = self._ids.pop()
+        if last_id != serial_id:
+            self._ids[position] = last_id
+            self._id_positions[last_id] = position
+        for language, name in self._get_language_keys(serial):
+            letter_counts = self._letter_counts[language]
+            letter_counts[name[0]] -= 1
+            if not letter_counts[name[0]]:
+                del letter_counts[name[0]]
+        if sort:
+            for letter, name in self._get_letter_keys(serial).items():
+                letter_names = self._letters[letter]
+                del letter_names[bisect_left(letter_names, (name, serial_id))]
+                if not letter_names:
+                    del self._letters[letter]
+        for name in self._get_keys(serial):
+            for ngram in get_ngrams(name):
+                postings = self._ngrams[ngram]
+                postings.discard(serial_id)
+                if not postings:
+                    del self._ngrams[ngram]
+            if sort:
+                position = bisect_left(self._names, (name, serial_id))
+                del self._names[position]
+
+    @staticmethod
+    def _get_keys(serial):
+        return {normalize_name(serial.name_rus),
+                normalize_name(serial.name_eng)}
+
+    @staticmethod
+    def _get_language_keys(serial):
+        return [(language, normalize_name(name)) for language, name
+                in (('RUS', serial.name_rus), ('ENG', serial.name_eng))
+                if name]
+
+    @classmethod
+    def _get_letter_keys(cls, serial):
+        letters = {}
+        for name in sorted(cls._get_keys(serial)):
+            if name:
+                letters.setdefault(name[0], name)
+        return letters
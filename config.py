@@ -12,7 +12,17 @@ class Config():
         db_name = os.getenv('DB_NAME', '')
         db_user = os.getenv('DB_USER', '')
         db_password = os.getenv('DB_PASSWORD', '')
-        self.db_url = f'mysql+pymysql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}' # noqa: E501
+        # DB_URL overrides the MySQL settings, e.g. sqlite:///local.db
+        db_url = os.getenv('DB_URL', '')
+        self.db_url = db_url or f'mysql+pymysql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}' # noqa: E501
+        self.db_pool_size = int(os.getenv('DB_POOL_SIZE', '10'))
+        # milliseconds
+        self.db_slow_query_threshold = int(
+            os.getenv('DB_SLOW_QUERY_THRESHOLD', '500'))
+        self.db_explain_sample_rate = float(
+            os.getenv('DB_EXPLAIN_SAMPLE_RATE', '0'))
+        self.db_n_plus_one_threshold = int(
+            os.getenv('DB_N_PLUS_ONE_THRESHOLD', '10'))
 
         tg_bot_token = os.getenv('TG_BOT_TOKEN', '')
         self.tg_bot_token = tg_bot_token
@@ -20,13 +30,69 @@ class Config():
         self.tg_webhook_url = os.getenv('TG_WEBHOOK_URL')
         self.tg_webhook_port = int(os.getenv('TG_WEBHOOK_PORT', '5000'))
 
+        # Prometheus metrics endpoint, disabled by default (port 0)
+        self.metrics_host = os.getenv('METRICS_HOST', '127.0.0.1')
+        self.metrics_port = int(os.getenv('METRICS_PORT', '0'))
+
         self.parameters = {
             'debug': os.getenv('DEBUG', 'False').lower() == 'true',
             'storage_chat_id': int(os.getenv('STORAGE_CHAT_ID', )),
             'page_length': int(os.getenv('MAX_PAGE_LENGTH', '10')),
             'kp_api_key': os.getenv('KINOPOISK_API_KEY', ''),
+            'kp_api_url': os.getenv(
+                'KINOPOISK_API_URL', 'https://kinopoiskapiunofficial.tech'),
+            'kp_http2':
+                os.getenv('KINOPOISK_HTTP2', 'False').lower() == 'true',
+            # requests per second
+            'kp_rate_limit': float(os.getenv('KINOPOISK_RATE_LIMIT', '20')),
+            'kp_max_retries': int(os.getenv('KINOPOISK_MAX_RETRIES', '3')),
+            # seconds
+            'kp_max_retry_after': int(
+                os.getenv('KINOPOISK_MAX_RETRY_AFTER', '60')),
+            'kp_import_concurrency': int(
+                os.getenv('KINOPOISK_IMPORT_CONCURRENCY', '5')),
+            'kp_import_batch_size': int(
+                os.getenv('KINOPOISK_IMPORT_BATCH_SIZE', '20')),
+            # Empty path disables the response cache, TTLs are in seconds.
+            # data/ is a volume in docker-compose.yaml
+            'kp_cache_path': os.getenv(
+                'KINOPOISK_CACHE_PATH', 'data/kinopoisk_cache.sqlite3'),
+            'kp_cache_ttls': {
+                'film': int(os.getenv('KINOPOISK_CACHE_TTL_FILM', '604800')),
+                'seasons': int(
+                    os.getenv('KINOPOISK_CACHE_TTL_SEASONS', '86400')),
+                'similars': int(
+                    os.getenv('KINOPOISK_CACHE_TTL_SIMILARS', '2592000')),
+            },
+            'catalog_refresh_interval': int(
+                os.getenv('CATALOG_REFRESH_INTERVAL', '300')),
+            'catalog_cache_size': int(
+                os.getenv('CATALOG_CACHE_SIZE', '1024')),
+            'catalog_cache_ttl': int(os.getenv('CATALOG_CACHE_TTL', '600')),
+            'view_records_batch_size': int(
+                os.getenv('VIEW_RECORDS_BATCH_SIZE', '100')),
+            # milliseconds
+            'view_records_flush_interval': int(
+                os.getenv('VIEW_RECORDS_FLUSH_INTERVAL', '500')),
+            # Failed flushes of a batch before it is written record by record
+            'view_records_max_retries': int(
+                os.getenv('VIEW_RECORDS_MAX_RETRIES', '3')),
+            'view_records_max_queue_size': int(
+                os.getenv('VIEW_RECORDS_MAX_QUEUE_SIZE', '10000')),
+            # Navigation buttons edit the message instead of sending a new one
+            'edit_in_place': os.getenv(
+                'NAVIGATION_EDIT_IN_PLACE', 'True').lower() == 'true',
+            # Updates processed at once, one at a time within a chat
+            'concurrent_updates': int(os.getenv('CONCURRENT_UPDATES', '64')),
+            # Bot API requests per second, per minute for groups
+            'rate_limit_global': float(os.getenv('RATE_LIMIT_GLOBAL', '30')),
+            'rate_limit_chat': float(os.getenv('RATE_LIMIT_CHAT', '1')),
+            'rate_limit_group': float(os.getenv('RATE_LIMIT_GROUP', '20')),
+            'rate_limit_max_retries': int(
+                os.getenv('RATE_LIMIT_MAX_RETRIES', '3')),
         }
 
         # TODO: use pydantic instead
-        if not db_name or not db_user or not db_password or not tg_bot_token:
+        db_configured = db_url or (db_name and db_user and db_password)
+        if not db_configured or not tg_bot_token:
             raise ValueError('Some params does not set')
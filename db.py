@@ -1,43 +1,98 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import sessionmaker
 
+from instrumentation import current_update_stats
 from models import Base
+from profiler import QueryProfiler, current_query_function
 
 
 class Database:
-    def __init__(self, db_url, echo=False):
+    def __init__(self, db_url, echo=False, pool_size=10,
+                 slow_query_threshold=0.5, explain_sample_rate=0.0,
+                 n_plus_one_threshold=10):
         """
         Initialize the database connection.
 
         Args:
             db_url (str): URL for connecting to the database
             echo (bool): Log SQL queries (for debugging)
+            pool_size (int): Number of pooled connections and of worker
+                threads used by `run`
+            slow_query_threshold (float): Log queries slower than this,
+                in seconds
+            explain_sample_rate (float): Share of slow SELECT queries
+                logged with their EXPLAIN plan
+            n_plus_one_threshold (int): Report a statement repeated this
+                many times within one update
         """
+        if db_url.startswith('sqlite'):
+            # Local stand-in for tests: sessions are used from worker threads
+            engine_options = {'connect_args': {'check_same_thread': False}}
+        else:
+            engine_options = {
+                'pool_size': pool_size,
+                'max_overflow': 20,
+                'pool_recycle': 3600,
+                'pool_pre_ping': True,
+            }
         self.engine = create_engine(
             db_url,
             echo=echo,
-            pool_size=10,
-            max_overflow=20,
-            pool_recycle=3600,
-            pool_pre_ping=True
+            **engine_options
         )
-        
+
+        # Objects returned from `run` are used after the session is closed
         self.SessionLocal = sessionmaker(
             autocommit=False,
             autoflush=False,
+            expire_on_commit=False,
             bind=self.engine
         )
-        
+
         self.Base = Base
 
+        self.profiler = QueryProfiler(
+            self.engine,
+            slow_query_threshold=slow_query_threshold,
+            explain_sample_rate=explain_sample_rate,
+            n_plus_one_threshold=n_plus_one_threshold,
+        )
+
+        # session.info key -> hooks called after a successful commit with
+        # the ids marked as changed, see queries.mark_serial_changed and
+        # queries.mark_episode_changed
+        self.commit_hooks = defaultdict(list)
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=pool_size,
+            thread_name_prefix='db',
+        )
+
     def init_db(self):
         """
         Initialize the database.
-        Creates tables based on models if necessary.
+        Creates tables based on models if necessary, and indexes added to
+        models of tables that already exist. Run by migrate.py before the
+        bot is started, not on every startup.
         """
         self.Base.metadata.create_all(bind=self.engine)
+        inspector = inspect(self.engine)
+        for table in self.Base.metadata.tables.values():
+            existing = {index['name']
+                        for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    logging.info(f'Creating index {index.name}')
+                    index.create(bind=self.engine)
 
     @contextmanager
     def session(self):
@@ -55,12 +110,53 @@ class Database:
         try:
             yield session
             session.commit()
+            self._run_commit_hooks(session)
         except Exception:
             session.rollback()
             raise
         finally:
             session.close()
 
+    async def run(self, func, *args, **kwargs):
+        """
+        Awaitable counterpart of `session()`.
+        Calls func(session, *args, **kwargs) in a worker thread inside
+        `session()`, so the event loop is not blocked. The session is
+        committed after func returns and rolled back if it raises.
+
+        Usage:
+            serial = await database.run(get_serial_by_id, serial_id)
+
+        Returns:
+            The value returned by func
+        """
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        call = functools.partial(
+            context.run, self._run_in_session, func, *args, **kwargs)
+        return await loop.run_in_executor(self.executor, call)
+
+    def _run_commit_hooks(self, session):
+        for key, hooks in self.commit_hooks.items():
+            changed_ids = session.info.pop(key, None)
+            if not changed_ids:
+                continue
+            for hook in hooks:
+                hook(changed_ids)
+
+    def _run_in_session(self, func, *args, **kwargs):
+        current_query_function.set(func.__name__)
+        started_at = time.perf_counter()
+        try:
+            with self.session() as session:
+                return func(session, *args, **kwargs)
+        finally:
+            # Runs in the context copied by `run`, so this is the update
+            # that called it
+            stats = current_update_stats.get()
+            if stats is not None:
+                stats.db_time += time.perf_counter() - started_at
+
     def get_session(self):
         """
         Get a database session (without context manager).
@@ -70,3 +166,10 @@ class Database:
             Session: Database session
         """
         return self.SessionLocal()
+
+    def close(self):
+        """
+        Wait for running queries, stop worker threads and close connections.
+        """
+        self.executor.shutdown(wait=True)
+        self.engine.dispose()
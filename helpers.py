@@ -10,6 +10,7 @@ LISTSEASONS = '🗂️ Список сезонов'
 SERIALDETAILS = '\u2139 Информация о сериале'
 COMPLAIN = '⚠ Сообщить о проблеме'
 SUPPORT_LINK = 'tg://resolve?domain=AlexWolf_kornet'
+CURSOR_DIRECTIONS = {'n': 'next', 'p': 'prev', 'l': 'last'}
 
 
 def format_numeric(number, keyword):
@@ -84,29 +85,61 @@ def get_alphabet_markup(letters):
     return InlineKeyboardMarkup(keyboard)
 
 
-def get_paginated_markup(buttons_callbacks, list_type, current_page=1, total_pages=1, ):  # noqa: E501
+def encode_cursor(direction, key=()):
+    """('next', (12, 345)) -> 'n12.345'"""
+    return direction[0] + '.'.join(str(value) for value in key)
+
+
+def decode_cursor(cursor, key_length):
+    """
+    'n12.345' -> ('next', (12, 345)) for a key of key_length columns,
+    None (the first page) for malformed cursors
+    """
+    direction = CURSOR_DIRECTIONS.get(cursor[:1])
+    values = cursor[1:].split('.') if cursor[1:] else []
+    if direction is None or \
+            len(values) != (0 if direction == 'last' else key_length):
+        return None
+    try:
+        return direction, tuple(int(value) for value in values)
+    except ValueError:
+        return None
+
+
+def get_paginated_markup(buttons_callbacks, list_type, current_page=1, total_pages=1, page_keys=None):  # noqa: E501
+    """
+    page_keys - keys of the first and last rows of a keyset-paginated page
+    (see queries.get_keyset_page), which are passed in callback data of
+    navigation buttons.
+    """
     keyboard = [
         [InlineKeyboardButton(**button_callback)]
         for button_callback in buttons_callbacks
     ]
     if total_pages == 1:
         return InlineKeyboardMarkup(keyboard)
+    prev_cursor = next_cursor = last_cursor = ''
+    if page_keys:
+        first_key, last_key = page_keys
+        prev_cursor = f'_{encode_cursor("prev", first_key)}'
+        next_cursor = f'_{encode_cursor("next", last_key)}'
+        last_cursor = f'_{encode_cursor("last")}'
     keyboard.append([
         InlineKeyboardButton(
             text='1⏮️',
             callback_data=f'{list_type}_1' if current_page > 1 else '-'),
         InlineKeyboardButton(
             text='◀️',
-            callback_data=f'{list_type}_{current_page - 1}'
+            callback_data=f'{list_type}_{current_page - 1}{prev_cursor}'
                           if current_page > 1 else '-'),
         InlineKeyboardButton(f'{current_page}', callback_data='-'),
         InlineKeyboardButton(
             text='▶️',
-            callback_data=f'{list_type}_{current_page+1}'
+            callback_data=f'{list_type}_{current_page+1}{next_cursor}'
                           if current_page < total_pages else '-'),
         InlineKeyboardButton(
             text=f'⏭️{total_pages}',
-            callback_data=f'{list_type}_{total_pages}'
+            callback_data=f'{list_type}_{total_pages}{last_cursor}'
                           if current_page < total_pages else '-'),
     ])
     return InlineKeyboardMarkup(keyboard)
@@ -0,0 +1,169 @@
+import logging
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from telegram.ext import Application, CommandHandler, ConversationHandler
+from telegram.request import HTTPXRequest
+
+from metrics import Counter as CounterMetric
+from metrics import Histogram
+
+UPDATE_DURATION = Histogram(
+    'bot_update_duration_seconds',
+    'Time spent processing an update, by handler route')
+UPDATE_DB_TIME = Histogram(
+    'bot_update_db_seconds',
+    'Time spent in database queries per update, by handler route')
+UPDATE_DB_QUERIES = Histogram(
+    'bot_update_db_queries',
+    'SQL statements executed per update, by handler route',
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+API_REQUESTS = CounterMetric(
+    'bot_api_requests_total', 'Bot API requests, by method')
+API_DURATION = Histogram(
+    'bot_api_request_duration_seconds', 'Bot API request latency, by method')
+
+
+class UpdateStats:
+    """
+    Work done while processing a single update.
+    """
+    def __init__(self, update_id=None, route=None):
+        self.update_id = update_id
+        self.route = route
+        self.api_calls = Counter()
+        self.api_time = 0.0
+        self.db_time = 0.0
+        self.db_queries = 0
+        # Seconds spent in process_update
+        self.duration = 0.0
+        # Normalized statement -> number of executions, see profiler.py
+        self.db_statements = Counter()
+
+    @property
+    def api_calls_total(self):
+        return sum(self.api_calls.values())
+
+
+# Stats of the update handled by the current task, None outside of handlers
+current_update_stats = ContextVar('current_update_stats', default=None)
+
+
+def get_commands(handlers):
+    commands = set()
+    for handler in handlers:
+        if isinstance(handler, CommandHandler):
+            commands.update(handler.commands)
+        elif isinstance(handler, ConversationHandler):
+            commands.update(get_commands(handler.entry_points))
+            for state_handlers in handler.states.values():
+                commands.update(get_commands(state_handlers))
+            commands.update(get_commands(handler.fallbacks))
+    return commands
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    HTTPXRequest that records Bot API calls into the stats of the update
+    being processed and into the Bot API metrics.
+    """
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return await super().do_request(url, method, request_data,
+                                            **kwargs)
+        finally:
+            endpoint = url.rsplit('/', 1)[-1]
+            latency = time.perf_counter() - started_at
+            API_REQUESTS.inc(method=endpoint)
+            API_DURATION.observe(latency, method=endpoint)
+            stats = current_update_stats.get()
+            if stats is not None:
+                stats.api_calls[endpoint] += 1
+                stats.api_time += latency
+
+
+class InstrumentedApplication(Application):
+    """
+    Application that collects UpdateStats for every update, logs the
+    number of Bot API calls it took and records handler metrics.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Called with the UpdateStats of every processed update
+        self.update_stats_callbacks = []
+
+    async def process_update(self, update):
+        stats = UpdateStats(getattr(update, 'update_id', None),
+                            self.get_update_route(update))
+        token = current_update_stats.set(stats)
+        started_at = time.perf_counter()
+        try:
+            await super().process_update(update)
+        finally:
+            current_update_stats.reset(token)
+            stats.duration = time.perf_counter() - started_at
+            UPDATE_DURATION.observe(stats.duration, route=stats.route)
+            UPDATE_DB_TIME.observe(stats.db_time, route=stats.route)
+            UPDATE_DB_QUERIES.observe(stats.db_queries, route=stats.route)
+            logging.getLogger(__name__).info(
+                f'📤 Update {stats.update_id} ({stats.route}): '
+                f'{stats.api_calls_total} Bot API calls '
+                f'{dict(stats.api_calls)} in {stats.api_time:.3f}s, '
+                f'DB {stats.db_queries} queries in {stats.db_time:.3f}s')
+            for callback in self.update_stats_callbacks:
+                callback(stats)
+
+    def get_update_route(self, update):
+        """
+        Metrics label of the handler an update goes to: the callback data
+        prefix or the command. Unknown commands share one label to keep
+        the number of series bounded.
+        """
+        callback_query = getattr(update, 'callback_query', None)
+        if callback_query:
+            return f'callback:{(callback_query.data or "").split("_")[0]}'
+        message = getattr(update, 'effective_message', None)
+        if not message:
+            return 'other'
+        text = message.text or message.caption or ''
+        if text.startswith('/'):
+            command = text.split()[0][1:].split('@')[0].lower()
+            if not hasattr(self, '_commands'):
+                self._commands = get_commands(
+                    handler for handlers in self.handlers.values()
+                    for handler in handlers)
+            return f'command:{command if command in self._commands else "?"}'
+        if message.document:
+            return 'document'
+        return 'text' if message.text else 'other'
+
+
+def collect_application_metrics(application):
+    """
+    Registry collector of gauges read from the application at scrape time:
+    update queue, caches, view record writer and Bot API rate limiter.
+    """
+    families = [(
+        'bot_update_queue_depth', 'gauge', 'Updates waiting to be processed',
+        [('bot_update_queue_depth', (), application.update_queue.qsize())],
+    )]
+    cache_stats = application.catalog_cache.stats()
+    for field in ('size', 'hits', 'misses', 'evictions'):
+        families.append((
+            f'bot_cache_{field}', 'gauge', f'Catalog cache {field}',
+            [(f'bot_cache_{field}', (('cache', name), ), stats[field])
+             for name, stats in cache_stats.items()],
+        ))
+    for prefix, source in (
+            ('bot_view_writer', application.view_record_writer),
+            ('bot_rate_limiter', application.bot.rate_limiter)):
+        if source is None:
+            continue
+        for field, value in source.stats().items():
+            families.append((
+                f'{prefix}_{field}', 'gauge', f'{prefix} {field}',
+                [(f'{prefix}_{field}', (), value)],
+            ))
+    return families
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+CachedResponse = namedtuple(
+    'CachedResponse', ['data', 'etag', 'last_modified', 'fetched_at'])
+
+# Seconds a response stays fresh, seasons get new episodes most often
+DEFAULT_TTLS = {
+    'film': 7 * 24 * 3600,
+    'seasons': 24 * 3600,
+    'similars': 30 * 24 * 3600,
+}
+
+
+class KinopoiskCache:
+    """
+    Persistent SQLite cache of Kinopoisk API responses keyed by endpoint
+    and film id. Responses older than the TTL of their endpoint are
+    revalidated with their ETag/Last-Modified when the API provides them.
+    """
+    def __init__(self, path, ttls=None):
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'endpoint TEXT NOT NULL, '
+                'kp_id TEXT NOT NULL, '
+                'data TEXT NOT NULL, '
+                'etag TEXT, '
+                'last_modified TEXT, '
+                'fetched_at REAL NOT NULL, '
+                'PRIMARY KEY (endpoint, kp_id))'
+            )
+
+    def is_fresh(self, endpoint, cached):
+        return time.time() - cached.fetched_at < self.ttls.get(endpoint, 0)
+
+    async def get(self, endpoint, kp_id):
+        return await asyncio.to_thread(self._get, endpoint, str(kp_id))
+
+    async def set(self, endpoint, kp_id, data, etag=None,
+                  last_modified=None):
+        await asyncio.to_thread(self._set, endpoint, str(kp_id),
+                                json.dumps(data, ensure_ascii=False),
+                                etag, last_modified)
+
+    async def touch(self, endpoint, kp_id):
+        """
+        Mark a revalidated response as fresh again.
+        """
+        self.revalidations += 1
+        await asyncio.to_thread(self._execute,
+                                'UPDATE responses SET fetched_at = ? '
+                                'WHERE endpoint = ? AND kp_id = ?',
+                                (time.time(), endpoint, str(kp_id)))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _get(self, endpoint, kp_id):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT data, etag, last_modified, fetched_at FROM responses '
+                'WHERE endpoint = ? AND kp_id = ?', (endpoint, kp_id)
+            ).fetchone()
+        if row is None:
+            return None
+        data, etag, last_modified, fetched_at = row
+        return CachedResponse(json.loads(data), etag, last_modified,
+                              fetched_at)
+
+    def _set(self, endpoint, kp_id, data, etag, last_modified):
+        self._execute(
+            'INSERT OR REPLACE INTO responses '
+            '(endpoint, kp_id, data, etag, last_modified, fetched_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (endpoint, kp_id, data, etag, last_modified, time.time()))
+
+    def _execute(self, statement, parameters):
+        with self._lock, self._connection:
+            self._connection.execute(statement, parameters)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'hit_ratio': self.hits / requests if requests else 0.0,
+        }
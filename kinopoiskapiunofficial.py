@@ -1,34 +1,131 @@
+import asyncio
+import logging
+import random
+
 import httpx
 
+from rate_limiter import TokenBucket
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
 
 class KinopoiskApi():
-    def __init__(self, api_key):
-        self.headers = {'X-API-KEY': api_key,
-                        'Content-Type': 'application/json', }
-
-    async def get_by_id(self, kp_id):
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f'https://kinopoiskapiunofficial.tech/api/v2.2/films/{kp_id}',
-                headers=self.headers
-            )
-        response.raise_for_status()
-        return response.json()
-
-    async def get_seasons_info(self, kp_id):
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f'https://kinopoiskapiunofficial.tech/api/v2.2/films/{kp_id}/seasons',  # noqa: E501
-                headers=self.headers
-            )
-        response.raise_for_status()
-        return response.json()
-
-    async def get_similar_films(self, kp_id):
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f'https://kinopoiskapiunofficial.tech/api/v2.2/films/{kp_id}/similars',  # noqa: E501
-                headers=self.headers
-            )
-        response.raise_for_status()
-        return response.json()
+    """
+    Client of kinopoiskapiunofficial.tech.
+    Keeps one pool of connections for all requests, spaces requests to
+    stay within the API rate limit and retries failed requests with
+    exponential backoff and jitter, waiting for Retry-After up to
+    `max_retry_after` seconds. Responses are kept in an optional
+    KinopoiskCache, `force_refresh` bypasses it. Call `aclose` when done.
+    """
+    BASE_URL = 'https://kinopoiskapiunofficial.tech'
+
+    def __init__(self, api_key, base_url=BASE_URL, http2=False,
+                 rate_limit=20, max_retries=3, backoff=0.5,
+                 max_retry_after=60, max_connections=10, timeout=10,
+                 cache=None):
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logging.warning('Пакет h2 не установлен, HTTP/2 отключен')
+                http2 = False
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_retry_after = max_retry_after
+        self.cache = cache
+        self.rate_limit = TokenBucket(rate_limit, rate_limit)
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={'X-API-KEY': api_key,
+                     'Content-Type': 'application/json', },
+            http2=http2,
+            limits=httpx.Limits(max_connections=max_connections),
+            timeout=timeout,
+        )
+
+    async def aclose(self):
+        await self.client.aclose()
+        if self.cache:
+            self.cache.close()
+
+    async def get_by_id(self, kp_id, force_refresh=False):
+        return await self._get_cached(
+            'film', kp_id, f'/api/v2.2/films/{kp_id}', force_refresh)
+
+    async def get_seasons_info(self, kp_id, force_refresh=False):
+        return await self._get_cached(
+            'seasons', kp_id, f'/api/v2.2/films/{kp_id}/seasons',
+            force_refresh)
+
+    async def get_similar_films(self, kp_id, force_refresh=False):
+        return await self._get_cached(
+            'similars', kp_id, f'/api/v2.2/films/{kp_id}/similars',
+            force_refresh)
+
+    async def get_with_seasons(self, kp_id, force_refresh=False):
+        """
+        Fetch a serial and its seasons concurrently.
+
+        Returns:
+            tuple: results of `get_by_id` and `get_seasons_info`
+        """
+        return tuple(await asyncio.gather(
+            self.get_by_id(kp_id, force_refresh),
+            self.get_seasons_info(kp_id, force_refresh),
+        ))
+
+    async def _get_cached(self, endpoint, kp_id, path, force_refresh):
+        if self.cache is None:
+            return (await self._get(path)).json()
+        cached = None if force_refresh \
+            else await self.cache.get(endpoint, kp_id)
+        if cached and self.cache.is_fresh(endpoint, cached):
+            self.cache.hits += 1
+            return cached.data
+        self.cache.misses += 1
+        headers = {}
+        if cached and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        response = await self._get(path, headers)
+        if response.status_code == 304:
+            await self.cache.touch(endpoint, kp_id)
+            return cached.data
+        data = response.json()
+        await self.cache.set(endpoint, kp_id, data,
+                             response.headers.get('ETag'),
+                             response.headers.get('Last-Modified'))
+        return data
+
+    async def _get(self, path, headers=None):
+        for attempt in range(self.max_retries + 1):
+            while delay := self.rate_limit.consume():
+                await asyncio.sleep(delay)
+            try:
+                response = await self.client.get(path, headers=headers)
+            except httpx.TransportError as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f'Kinopoisk API {path}: {e!r}')
+                await asyncio.sleep(self._get_retry_delay(attempt))
+                continue
+            if response.status_code in RETRY_STATUS_CODES \
+                    and attempt < self.max_retries:
+                logging.warning(
+                    f'Kinopoisk API {path}: {response.status_code}')
+                await asyncio.sleep(self._get_retry_delay(attempt, response))
+                continue
+            if response.status_code != 304:
+                response.raise_for_status()
+            return response
+
+    def _get_retry_delay(self, attempt, response=None):
+        retry_after = response is not None and \
+            response.headers.get('Retry-After', '')
+        if retry_after and retry_after.isdigit():
+            # A bad header must not stall all requests for hours
+            return min(int(retry_after), self.max_retry_after)
+        # Full jitter keeps concurrent retries from hitting the API together
+        return random.uniform(0, self.backoff * 2 ** attempt)
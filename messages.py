@@ -54,7 +54,8 @@ def format_episodes_message(serial, season, episodes, total_lines,
     return text, markup
 
 
-def format_history_message(serials, total_lines, page, page_length):
+def format_history_message(serials, total_lines, page, page_length,
+                           page_keys=None):
     total_pages = total_lines // page_length
     total_pages += 1 if total_lines % page_length else 0
     buttons = [get_button_text_for_serial(serial) for serial in serials]
@@ -64,16 +65,19 @@ def format_history_message(serials, total_lines, page, page_length):
         'В квадратных скобках указано количество просмотров эпизодов.'
         f'Страница {page} из {total_pages}'
     )
-    markup = get_paginated_markup(buttons, 'history', page, total_pages)
+    markup = get_paginated_markup(buttons, 'history', page, total_pages,
+                                  page_keys)
 
     return text, markup
 
 
 def format_play_message(bot_name, files, file_id, next_episode_id):
-    for row, file in enumerate(files):
+    for file in files:
         if file.file_id == file_id:
-            episode = files.pop(row)
+            episode = file
             break
+    # files may be shared through the cache, so they are not modified
+    files = [file for file in files if file is not episode]
     text = (
         f'<a href="{get_deep_link(bot_name, f'{episode.serial_id}')}">'
         f'<b>{episode.name_rus} ({episode.name_eng})</b></a>\n'
@@ -96,7 +100,8 @@ def format_random_serials_message(serials, ):
     return text, markup
 
 
-def format_rating_message(serials, total_lines, page, page_length):
+def format_rating_message(serials, total_lines, page, page_length,
+                          page_keys=None):
     total_pages = total_lines // page_length
     total_pages += 1 if total_lines % page_length else 0
     text=(
@@ -105,7 +110,8 @@ def format_rating_message(serials, total_lines, page, page_length):
         f'Страница {page} из {total_pages}'
     )
     buttons = [get_button_text_for_serial(serial) for serial in serials]
-    markup = get_paginated_markup(buttons, 'rating', page, total_pages)
+    markup = get_paginated_markup(buttons, 'rating', page, total_pages,
+                                  page_keys)
     return text, markup
 
 
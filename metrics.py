@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import defaultdict
+
+# Seconds, suits handler, query and Bot API latencies
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+    return f'{{{pairs}}}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    type = 'untyped'
+
+    def __init__(self, name, documentation, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    @abstractmethod
+    def collect(self):
+        """
+        Returns:
+            list: (name, labels, value) samples, labels is a tuple of
+            (label, value) pairs
+        """
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, documentation, registry=None):
+        super().__init__(name, documentation, registry)
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] += amount
+
+    def collect(self):
+        with self._lock:
+            return [(self.name, labels, value)
+                    for labels, value in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS,
+                 registry=None):
+        super().__init__(name, documentation, registry)
+        self.buckets = tuple(buckets)
+        # labels -> [counts per bucket and +Inf, sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._values.setdefault(
+                key, [[0] * (len(self.buckets) + 1), 0.0])
+            counts[0][bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def collect(self):
+        samples = []
+        with self._lock:
+            for labels, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'), ),
+                                        counts):
+                    cumulative += count
+                    samples.append((f'{self.name}_bucket',
+                                    labels + (('le', format_value(bound)), ),
+                                    cumulative))
+                samples.append((f'{self.name}_sum', labels, total))
+                samples.append((f'{self.name}_count', labels, cumulative))
+        return samples
+
+
+class Registry:
+    """
+    Metrics rendered together in the Prometheus text format.
+    Collectors are callables returning (name, type, documentation,
+    samples) for values that are read at scrape time, e.g. queue sizes.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        families = [(metric.name, metric.type, metric.documentation,
+                     metric.collect()) for metric in self.metrics]
+        for collector in self.collectors:
+            try:
+                families.extend(collector())
+            except Exception:
+                logging.exception('Ошибка при сборе метрик')
+        lines = []
+        for name, metric_type, documentation, samples in families:
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            lines.extend(f'{sample_name}{format_labels(labels)} '
+                         f'{format_value(value)}'
+                         for sample_name, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+async def start_metrics_server(host, port, registry=REGISTRY):
+    """
+    Serve GET /metrics of `registry` over HTTP.
+
+    Returns:
+        asyncio.Server: close it to stop serving
+    """
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Skip the headers, requests have no body
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.split()
+            if len(parts) > 1 and parts[0] == b'GET' \
+                    and parts[1].split(b'?')[0] == b'/metrics':
+                status = '200 OK'
+                body = registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.info(f'Метрики доступны на http://{host}:{port}/metrics')
+    return server
@@ -0,0 +1,33 @@
+"""
+Database migration, run once before starting a new version of the bot:
+    python migrate.py
+Creates tables and indexes added to models.py (see Database.init_db)
+and fills aggregate tables that are empty while view records exist.
+"""
+import logging
+
+from config import Config
+from db import Database
+from queries import get_unfilled_aggregates
+
+
+def main():
+    """Apply the schema of models.py to the configured database."""
+    logging.basicConfig(level=logging.INFO)
+    database = Database(Config().db_url)
+    try:
+        database.init_db()
+        with database.session() as db:
+            rebuilds = get_unfilled_aggregates(db)
+        for rebuild in rebuilds:
+            logging.info(f'Заполняем пустую таблицу: {rebuild.__name__}')
+            with database.session() as db:
+                rows = rebuild(db)
+            logging.info(f'{rebuild.__name__} завершен, записей: {rows}')
+    finally:
+        database.close()
+    logging.info('Схема базы данных обновлена')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,15 @@
 from sqlalchemy import Column, BigInteger, Integer, String, Text, ForeignKey, \
-    Boolean, UniqueConstraint, PrimaryKeyConstraint, Index, SmallInteger
+    Boolean, UniqueConstraint, PrimaryKeyConstraint, Index, SmallInteger, \
+    LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
 
 Base = declarative_base()
 
+# SQLite autoincrements only INTEGER primary keys (local test stand-in)
+AutoincrementBigInteger = BigInteger().with_variant(Integer, 'sqlite')
+
 
 class User(Base):
     __tablename__ = 'users'
@@ -67,9 +71,11 @@ class Episode(Base):
     __tablename__ = 'episodes'
     __table_args__ = (
         Index('ix_episodes_serial_id', 'serial_id'),
+        Index('ix_episodes_serial_season_episode',
+              'serial_id', 'season', 'episode'),
     )
 
-    id = Column(BigInteger, primary_key=True, nullable=False,
+    id = Column(AutoincrementBigInteger, primary_key=True, nullable=False,
                 autoincrement=True)
     serial_id = Column(BigInteger, ForeignKey('serials.id'), nullable=False)
     season = Column(Integer, nullable=False, default=0)
@@ -152,6 +158,74 @@ class EpisodeViewRecord (Base):
         return f'<EpisodeViewRecord(user_id={self.user_id}, episode_id={self.episode_id})>'  # noqa: E501
 
 
+class SerialViewer(Base):
+    __tablename__ = 'serial_viewers'
+    __table_args__ = (
+        PrimaryKeyConstraint('user_id', 'serial_id'),
+    )
+
+    user_id = Column(BigInteger, ForeignKey('users.id'), nullable=False)
+    serial_id = Column(BigInteger, ForeignKey('serials.id'), nullable=False)
+
+    def __repr__(self):
+        return f'<SerialViewer(user_id={self.user_id}, serial_id={self.serial_id})>'  # noqa: E501
+
+
+class SerialPopularity(Base):
+    __tablename__ = 'serial_popularity'
+    __table_args__ = (
+        Index('ix_serial_popularity_users', 'users', 'serial_id'),
+    )
+
+    serial_id = Column(BigInteger, ForeignKey('serials.id'), primary_key=True,
+                       nullable=False)
+    users = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<SerialPopularity(serial_id={self.serial_id}, users={self.users})>'  # noqa: E501
+
+
+class ViewHistoryGroup(Base):
+    """
+    Consecutive views of one serial by a user. Only the latest group of
+    a user is extended, so ids of a user's groups grow with last_viewed_at.
+    """
+    __tablename__ = 'view_history_groups'
+    __table_args__ = (
+        Index('ix_view_history_groups_user_id', 'user_id', 'id'),
+    )
+
+    id = Column(AutoincrementBigInteger, primary_key=True, nullable=False,
+                autoincrement=True)
+    user_id = Column(BigInteger, ForeignKey('users.id'), nullable=False)
+    serial_id = Column(BigInteger, ForeignKey('serials.id'), nullable=False)
+    views = Column(Integer, nullable=False, default=0)
+    first_viewed_at = Column(String(26), nullable=False)
+    last_viewed_at = Column(String(26), nullable=False)
+
+    def __repr__(self):
+        return f'<ViewHistoryGroup(id={self.id}, user_id={self.user_id}, serial_id={self.serial_id})>'  # noqa: E501
+
+
+class WatchedEpisodes(Base):
+    """
+    Episodes of a season watched by a user, packed as a bitmap where
+    bit N (byte N // 8, bit N % 8) stands for the episode number N.
+    """
+    __tablename__ = 'watched_episodes'
+    __table_args__ = (
+        PrimaryKeyConstraint('user_id', 'serial_id', 'season'),
+    )
+
+    user_id = Column(BigInteger, ForeignKey('users.id'), nullable=False)
+    serial_id = Column(BigInteger, ForeignKey('serials.id'), nullable=False)
+    season = Column(Integer, nullable=False)
+    bitmap = Column(LargeBinary, nullable=False, default=b'')
+
+    def __repr__(self):
+        return f'<WatchedEpisodes(user_id={self.user_id}, serial_id={self.serial_id}, season={self.season})>'  # noqa: E501
+
+
 class RequestedNewMovie(Base):
     __tablename__ = 'requested_new_movie'
 
@@ -191,7 +265,7 @@ class KPSerial(Base):
 class KPEpisode(Base):
     __tablename__ = 'kp_episodes'
 
-    id = Column(BigInteger, primary_key=True, autoincrement=True,
+    id = Column(AutoincrementBigInteger, primary_key=True, autoincrement=True,
                 nullable=False)
     kp_serial_id = Column(BigInteger, ForeignKey('kp_serials.kp_id'),
                           nullable=False)
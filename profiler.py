@@ -0,0 +1,112 @@
+import logging
+import random
+import re
+import threading
+import time
+from collections import namedtuple
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from instrumentation import current_update_stats
+
+QueryStats = namedtuple('QueryStats',
+                        ['statement', 'count', 'total_time', 'max_time'])
+
+# Name of the queries.py function run by Database.run in this context
+current_query_function = ContextVar('current_query_function', default=None)
+
+# IN lists and VALUES rows of different lengths are the same query
+PLACEHOLDER_LIST = re.compile(
+    r'\((?:\s*(?:\?|%s|%\(\w+\)s)\s*,)+\s*(?:\?|%s|%\(\w+\)s)\s*\)')
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_statement(statement):
+    return PLACEHOLDER_LIST.sub('(...)', WHITESPACE.sub(' ', statement)) \
+        .strip()
+
+
+class QueryProfiler:
+    """
+    Engine event hooks that time every SQL statement.
+    Statement counts and time go to the stats of the current update, and
+    totals per statement are kept for `top`. Statements slower than
+    `slow_query_threshold` seconds are logged with the update route and
+    query function, for a share of them (`explain_sample_rate`) with their
+    EXPLAIN plan. A statement repeated `n_plus_one_threshold` times within
+    one update is reported as a likely N+1 pattern.
+    """
+    def __init__(self, engine, slow_query_threshold=0.5,
+                 explain_sample_rate=0.0, n_plus_one_threshold=10):
+        self.slow_query_threshold = slow_query_threshold
+        self.explain_sample_rate = explain_sample_rate
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.explain_prefix = 'EXPLAIN QUERY PLAN ' \
+            if engine.dialect.name == 'sqlite' else 'EXPLAIN '
+        self._queries = {}
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute',
+                     self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        conn.info.setdefault('query_started_at', []).append(
+            time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        duration = time.perf_counter() - conn.info['query_started_at'].pop()
+        key = normalize_statement(statement)
+        with self._lock:
+            count, total_time, max_time = self._queries.get(key, (0, 0.0, 0))
+            self._queries[key] = (count + 1, total_time + duration,
+                                  max(max_time, duration))
+
+        stats = current_update_stats.get()
+        if stats is not None:
+            stats.db_queries += 1
+            stats.db_statements[key] += 1
+            if stats.db_statements[key] == self.n_plus_one_threshold:
+                logging.warning(
+                    f'Possible N+1 in update {stats.update_id} '
+                    f'({stats.route}, {current_query_function.get()}): '
+                    f'executed {self.n_plus_one_threshold} times: {key}')
+
+        if duration >= self.slow_query_threshold:
+            route = stats.route if stats is not None else None
+            message = (f'Slow query {duration:.3f}s in '
+                       f'{current_query_function.get()} ({route}): {key}')
+            if not executemany and key.upper().startswith('SELECT') \
+                    and random.random() < self.explain_sample_rate:
+                message += '\n' + self._explain(cursor, statement, parameters)
+            logging.warning(message)
+
+    def _explain(self, cursor, statement, parameters):
+        try:
+            explain_cursor = cursor.connection.cursor()
+            try:
+                explain_cursor.execute(self.explain_prefix + statement,
+                                       parameters)
+                return '\n'.join(str(row) for row in explain_cursor.fetchall())
+            finally:
+                explain_cursor.close()
+        except Exception as e:
+            return f'EXPLAIN failed: {e!r}'
+
+    def top(self, limit=10):
+        """
+        Returns:
+            list: QueryStats of `limit` statements with the most total time
+        """
+        with self._lock:
+            queries = sorted(self._queries.items(),
+                             key=lambda item: item[1][1], reverse=True)
+        return [QueryStats(statement, *values)
+                for statement, values in queries[:limit]]
+
+    def reset(self):
+        with self._lock:
+            self._queries.clear()
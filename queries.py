@@ -1,101 +1,185 @@
 import logging
+import operator
+from collections import Counter
 from datetime import datetime
 
-from sqlalchemy import and_, case, distinct, func, or_
+from sqlalchemy import and_, case, func, insert, or_, tuple_
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 
 from models import (Audio, Episode, EpisodeViewRecord, File, KPEpisode,
-                    KPSerial, Poster, RequestedNewMovie, Serial, User)
+                    KPSerial, Poster, RequestedNewMovie, Serial,
+                    SerialPopularity, SerialViewer, User, ViewHistoryGroup,
+                    WatchedEpisodes)
+
+
+def mark_serial_changed(db: Session, serial_id: int):
+    """
+    Запоминает измененный сериал, чтобы после коммита сбросить его кэш
+    """
+    db.info.setdefault('changed_serials', set()).add(int(serial_id))
+
+
+def mark_episode_changed(db: Session, episode_id: int):
+    """
+    Запоминает эпизод, у которого изменились файлы или озвучка, чтобы
+    после коммита сбросить его кэш воспроизведения
+    """
+    db.info.setdefault('changed_episodes', set()).add(int(episode_id))
+
+
+def get_keyset_page(query, key_columns: list, limit: int, page: int,
+                    total: int, cursor: tuple = None):
+    """
+    Страница запроса, упорядоченного по убыванию key_columns, без OFFSET.
+    cursor (см. helpers.decode_cursor):
+        ('next', key) - страница после строки с ключом key,
+        ('prev', key) - страница перед строкой с ключом key,
+        ('last', ()) - последняя страница.
+    Без cursor страница выбирается по номеру page.
+
+    Returns:
+        tuple: строки страницы, ключи ее первой и последней строки
+    """
+    query = query.add_columns(*key_columns)
+    descending = [column.desc() for column in key_columns]
+    ascending = [column.asc() for column in key_columns]
+    direction, key = cursor or (None, None)
+    if direction == 'next':
+        rows = query.filter(
+            get_keyset_condition(key_columns, key, operator.lt)
+        ).order_by(*descending).limit(limit).all()
+    elif direction == 'prev':
+        rows = query.filter(
+            get_keyset_condition(key_columns, key, operator.gt)
+        ).order_by(*ascending).limit(limit).all()[::-1]
+    elif direction == 'last':
+        last_page_length = (total - 1) % limit + 1 if total else 0
+        rows = query.order_by(*ascending).limit(last_page_length).all()[::-1]
+    else:
+        rows = query.order_by(*descending).limit(limit) \
+            .offset(limit * (page - 1)).all()
+
+    key_length = len(key_columns)
+    page_keys = (tuple(rows[0][-key_length:]),
+                 tuple(rows[-1][-key_length:])) if rows else None
+    return [row[:-key_length] for row in rows], page_keys
+
+
+def get_keyset_condition(key_columns: list, key: tuple, compare):
+    """
+    Лексикографическое сравнение (a, b) < (x, y) в виде
+    a < x OR (a = x AND b < y), которое MySQL выполняет по индексу.
+    """
+    conditions = []
+    for position, column in enumerate(key_columns):
+        equal = [key_column == value for key_column, value
+                 in zip(key_columns[:position], key[:position])]
+        conditions.append(and_(*equal, compare(column, key[position])))
+    return or_(*conditions)
+
+
+def get_bit(bitmap: bytes, position: int) -> bool:
+    byte, bit = divmod(position, 8)
+    return 0 <= byte < len(bitmap) and bool(bitmap[byte] >> bit & 1)
+
+
+def set_bit(bitmap: bytes, position: int) -> bytes:
+    byte, bit = divmod(position, 8)
+    bitmap = bytearray(bitmap)
+    if byte >= len(bitmap):
+        bitmap.extend(bytes(byte + 1 - len(bitmap)))
+    bitmap[byte] |= 1 << bit
+    return bytes(bitmap)
+
+
+def get_set_bits(bitmap: bytes) -> list[int]:
+    return [byte * 8 + bit
+            for byte, value in enumerate(bitmap) if value
+            for bit in range(8) if value >> bit & 1]
 
 
 def get_aggregated_view_history(db: Session, user_id: int, limit: int = 10,
-                                offset: int = 0):
+                                page: int = 1, cursor: tuple = None):
     """
     Получает агрегированную историю просмотров по сериалам с группировкой по
-    последовательным просмотрам с поддержкой пагинации.
-    Если limit=0, то возвращает общее количество групп просмотров.
+    последовательным просмотрам с поддержкой пагинации (см. get_keyset_page).
+    Группы ведет insert_episode_view_records, последние - сверху.
     """
-    # Сначала создаем подзапрос, который вычисляет флаг изменения сериала
-    subquery = db.query(
-        EpisodeViewRecord.user_id,
-        EpisodeViewRecord.episode_id,
-        EpisodeViewRecord.created_at,
-        Serial.id.label('serial_id'),
+    query = db.query(
         Serial.name_rus,
         Serial.name_eng,
-        # Вычисляем предыдущий serial_id с помощью LAG
-        func.lag(Serial.id).over(
-            partition_by=EpisodeViewRecord.user_id,
-            order_by=EpisodeViewRecord.created_at
-        ).label('prev_serial_id')
-    ).join(Episode, EpisodeViewRecord.episode_id == Episode.id) \
-     .join(Serial, Episode.serial_id == Serial.id) \
-     .filter(EpisodeViewRecord.user_id == user_id) \
-     .subquery()
-
-    # Теперь в основном запросе вычисляем группу на основе сравнения с
-    # предыдущим serial_id и применяем агрегатную функцию SUM уже к простому
-    # полю CASE
-    cte_query = db.query(
-        subquery.c.user_id,
-        subquery.c.episode_id,
-        subquery.c.created_at,
-        subquery.c.serial_id,
-        subquery.c.name_rus,
-        subquery.c.name_eng,
-        subquery.c.prev_serial_id,
-        # Вычисляем группу с помощью SUM и CASE, но уже без оконных функций
-        func.sum(
-            case(
-                (subquery.c.serial_id != subquery.c.prev_serial_id, 1),
-                else_=0
-            )
-        ).over(
-            partition_by=subquery.c.user_id,
-            order_by=subquery.c.created_at
-        ).label('group_number')
-    ).subquery()
-
-    # Финальный запрос для агрегации по группам
-    query = db.query(
-        cte_query.c.name_rus,
-        cte_query.c.name_eng,
-        func.count().label('consecutive_views'),
-        cte_query.c.serial_id,
-    ).group_by(
-        cte_query.c.user_id,
-        cte_query.c.serial_id,
-        cte_query.c.group_number
-    ).order_by(func.max(cte_query.c.created_at).desc())
-
-    return query.limit(limit).offset(offset).all(), query.count()
-
-
-def get_alphabet_counts(db, language):
-    name_expr = case(
-        (language == 'RUS', Serial.name_rus),
-        else_=Serial.name_eng
-    )
+        ViewHistoryGroup.views.label('consecutive_views'),
+        ViewHistoryGroup.serial_id,
+    ).join(Serial, Serial.id == ViewHistoryGroup.serial_id) \
+     .filter(ViewHistoryGroup.user_id == user_id)
+    total = db.query(func.count(ViewHistoryGroup.id)).filter(
+        ViewHistoryGroup.user_id == user_id).scalar()
 
-    result = db.query(
-        func.upper(func.substr(name_expr, 1, 1)).label('letter'),
-        func.count(Serial.id).label('count')
-    ).group_by(
-        func.upper(func.substr(name_expr, 1, 1))
-    ).order_by(
-        'letter'
-    ).all()
-
-    return result
+    rows, page_keys = get_keyset_page(query, [ViewHistoryGroup.id], limit,
+                                      page, total, cursor)
+    return rows, total, page_keys
 
 
-def get_random_serials(db, limit=10):
-    return db.query(
-        Serial.name_rus,
-        Serial.name_eng,
-        Serial.id,
-    ).order_by(func.rand()).limit(limit).all()
+def get_viewer_ranges(db: Session, chunk_size: int = 1000):
+    """
+    Диапазоны (первый, последний) user_id пользователей с просмотрами, по
+    chunk_size пользователей. Пачки читаются обычными запросами с
+    keyset-пагинацией: yield_per на MySQL держит небуферизованный курсор,
+    который PyMySQL молча дочитывает при следующем запросе в той же сессии.
+    """
+    last_user_id = None
+    while True:
+        query = db.query(EpisodeViewRecord.user_id).distinct().filter(
+            EpisodeViewRecord.user_id.is_not(None))
+        if last_user_id is not None:
+            query = query.filter(EpisodeViewRecord.user_id > last_user_id)
+        user_ids = [row.user_id for row in query.order_by(
+            EpisodeViewRecord.user_id).limit(chunk_size)]
+        if not user_ids:
+            return
+        yield user_ids[0], user_ids[-1]
+        last_user_id = user_ids[-1]
+
+
+def rebuild_view_history_groups(db: Session, chunk_size: int = 1000):
+    """
+    Пересчитывает view_history_groups по всей истории просмотров,
+    по chunk_size пользователей за запрос.
+    Возвращает количество групп.
+    """
+    db.query(ViewHistoryGroup).delete(synchronize_session=False)
+    total = 0
+    for first_user_id, last_user_id in get_viewer_ranges(db, chunk_size):
+        views = db.query(
+            EpisodeViewRecord.user_id,
+            Episode.serial_id,
+            EpisodeViewRecord.created_at,
+        ).join(Episode, EpisodeViewRecord.episode_id == Episode.id) \
+         .filter(EpisodeViewRecord.user_id.between(first_user_id,
+                                                   last_user_id)) \
+         .order_by(EpisodeViewRecord.user_id, EpisodeViewRecord.created_at) \
+         .all()
+
+        groups = []
+        for user_id, serial_id, created_at in views:
+            group = groups[-1] if groups else None
+            if group and (group['user_id'], group['serial_id']) == \
+                    (user_id, serial_id):
+                group['views'] += 1
+                group['last_viewed_at'] = created_at
+                continue
+            groups.append({
+                'user_id': user_id,
+                'serial_id': serial_id,
+                'views': 1,
+                'first_viewed_at': created_at,
+                'last_viewed_at': created_at,
+            })
+        if groups:
+            db.execute(insert(ViewHistoryGroup), groups)
+        total += len(groups)
+    return total
 
 
 def get_serial_by_id(db: Session, serial_id: int):
@@ -116,19 +200,12 @@ def get_serial_by_id(db: Session, serial_id: int):
     ).one_or_none()
 
 
-def get_serials_by_namepart(db: Session, name_part: str, limit=10, page=1):
-    offset = limit * (page - 1)
-    query = db.query(
+def get_serial_names(db: Session):
+    return db.query(
+        Serial.id,
         Serial.name_rus,
         Serial.name_eng,
-        Serial.id
-    ).filter(
-        or_(
-            Serial.name_rus.like(f'{name_part}'),
-            Serial.name_eng.like(f'{name_part}')
-        )
-    )
-    return query.limit(limit).offset(offset).all(), query.count()
+    ).all()
 
 
 def get_serial_by_search_key(db: Session, search_key: str, search_value: str):
@@ -157,28 +234,51 @@ def get_seasons_by_serial_id(db: Session, serial_id: int):
      .all()
 
 
-def get_kp_episodes_by_serial_id(db: Session, serial_id: int, ):
-    return db.query(
+def get_missing_kp_episode_conditions(db: Session, serial_id: int):
+    """
+    Условия для эпизодов kinopoisk.ru, которых еще нет у сериала и которые
+    не исключены. Запрос должен соединять KPEpisode с Serial.
+    """
+    return (
+        Serial.id == serial_id,
+        ~KPEpisode.ignore,
+        # Нет существующего эпизода
+        ~db.query(Episode.id).filter(
+            Episode.serial_id == Serial.id,
+            Episode.season == KPEpisode.season,
+            Episode.episode == KPEpisode.episode,
+        ).exists(),
+    )
+
+
+def get_kp_episodes_by_serial_id(db: Session, serial_id: int,
+                                 limit: int = 10, offset: int = 0):
+    """
+    Страница эпизодов kinopoisk.ru, которые можно добавить сериалу.
+    Если страница оказалась за концом списка (например, после добавления
+    эпизодов), возвращается последняя.
+
+    Returns:
+        tuple: эпизоды страницы, всего эпизодов, номер страницы
+    """
+    missing = db.query(KPEpisode).join(
+        Serial, Serial.kp_id == KPEpisode.kp_serial_id
+    ).filter(*get_missing_kp_episode_conditions(db, serial_id))
+    total_count = missing.with_entities(func.count(KPEpisode.id)).scalar()
+    if offset >= total_count:
+        offset = max(total_count - 1, 0) // limit * limit
+    rows = missing.with_entities(
         KPEpisode.id,
         KPEpisode.season,
         KPEpisode.episode,
         KPEpisode.name_rus,
         KPEpisode.name_eng
-    ).join(
-        Serial, Serial.kp_id == KPEpisode.kp_serial_id
-    ).outerjoin(
-        Episode,
-        (Episode.serial_id == Serial.id) &
-        (Episode.season == KPEpisode.season) &
-        (Episode.episode == KPEpisode.episode)
-    ).where(
-        Serial.id == serial_id,
-        Episode.id.is_(None),
-        KPEpisode.ignore == 0,
     ).order_by(
         KPEpisode.season,
-        KPEpisode.episode
-    ).all()
+        KPEpisode.episode,
+        KPEpisode.id,
+    ).limit(limit).offset(offset).all()
+    return rows, total_count, offset // limit + 1
 
 
 def get_episodes_by_serial_and_season(
@@ -188,42 +288,60 @@ def get_episodes_by_serial_and_season(
           user_id: int,
           limit: int = 10,
           offset: int = 0, ):
-    subquery = db.query(
-        EpisodeViewRecord.episode_id,
-        func.count(EpisodeViewRecord.created_at).label('views')
-    ).filter(EpisodeViewRecord.user_id == user_id) \
-     .group_by(EpisodeViewRecord.episode_id) \
-     .subquery()
+    """
+    Страница эпизодов сезона с отметкой просмотров пользователя из
+    битовой карты watched_episodes.
+    При offset < 0 возвращает страницу с первым непросмотренным эпизодом
+    (или последнюю, если просмотрены все).
 
-    query = db.query(
+    Returns:
+        tuple: эпизоды страницы, всего эпизодов, номер страницы
+    """
+    conditions = (
+        Episode.serial_id == serial_id,
+        Episode.season == season,
+        Episode.file_id.is_not(None),
+    )
+    total_count = db.query(func.count(Episode.id)).filter(*conditions) \
+        .scalar()
+
+    watched = db.get(WatchedEpisodes, (user_id, serial_id, season))
+    watched_numbers = get_set_bits(watched.bitmap) if watched else []
+
+    if offset < 0 and total_count:
+        first_unwatched = db.query(func.min(Episode.episode)).filter(
+            *conditions, Episode.episode.not_in(watched_numbers),
+        ).scalar()
+        if first_unwatched is None:
+            position = total_count - 1
+        else:
+            position = db.query(func.count(Episode.id)).filter(
+                *conditions, Episode.episode < first_unwatched).scalar()
+        offset = (position // limit) * limit
+    offset = max(offset, 0)
+
+    rows = db.query(
         Episode.season,
         Episode.episode,
         Episode.name,
         Episode.id,
         Episode.file_id,
-        subquery.c.views
-    ).join(subquery, subquery.c.episode_id == Episode.id, isouter=True, ) \
-     .filter(Episode.serial_id == serial_id, Episode.season == season,
-             Episode.file_id.is_not(None)) \
-     .group_by(Episode.id, Episode.episode, ) \
-     .order_by(Episode.episode)
-
-    all_episodes = query.all()
-    total_count = len(all_episodes)
-
-    if offset >= 0 or total_count == 0:
-        return all_episodes[offset:offset+limit], total_count, \
-            offset // limit + 1
-    for idx, episode in enumerate(all_episodes):
-        if episode.views is None:  # views берется из подзапроса
-            offset = (idx // limit) * limit
-            break
-    else:
-        offset = ((total_count - 1) // limit) * limit
-    return all_episodes[offset:offset+limit], total_count, offset // limit + 1
+    ).filter(*conditions) \
+     .order_by(Episode.episode, Episode.id) \
+     .limit(limit).offset(offset).all()
+    episodes = [
+        (*row, 1 if watched and get_bit(watched.bitmap, row.episode) else None)
+        for row in rows
+    ]
+
+    return episodes, total_count, offset // limit + 1
 
 
 def get_episode_by_id(db: Session, episode_id: int, ):
+    """
+    Эпизод со всеми файлами, озвучкой и постером сериала - по строке на
+    файл (одна строка с пустыми полями файла, если файлов нет).
+    """
     return db.query(
         Episode.id,
         Episode.serial_id,
@@ -238,53 +356,89 @@ def get_episode_by_id(db: Session, episode_id: int, ):
         File.height,
         Audio.name.label('audio'),
         Poster.file_id.label('poster_file_id'),
-    ).join(
-        Episode, Episode.serial_id == Serial.id, isouter=True,
-    ).join(
-        File, File.episode_id == Episode.id, isouter=True,
-    ).join(
-        Audio, Audio.id == File.audio_id, isouter=True,
-    ).filter(Episode.id == episode_id, Serial.poster_id == Poster.id).all()
+    ).select_from(Episode).join(
+        Serial, Serial.id == Episode.serial_id,
+    ).outerjoin(
+        Poster, Poster.id == Serial.poster_id,
+    ).outerjoin(
+        File, File.episode_id == Episode.id,
+    ).outerjoin(
+        Audio, Audio.id == File.audio_id,
+    ).filter(Episode.id == episode_id).order_by(File.id).all()
 
 
-def get_next_episode(db: Session, current_episode):
-    next_episode = db.query(
+def get_episode_order(db: Session, serial_id: int):
+    """
+    Все эпизоды сериала в порядке просмотра для поиска следующего эпизода
+    """
+    return db.query(
+        Episode.season,
+        Episode.episode,
         Episode.id,
-        Episode.file_id
-    ).filter(
-        Episode.serial_id == current_episode.serial_id,
-        or_(
-            and_(
-                Episode.season == current_episode.season,
-                Episode.episode > current_episode.episode
-            ),
-            and_(
-                Episode.season > current_episode.season,
-                Episode.episode == db.query(func.min(Episode.episode)).filter(
-                    Episode.serial_id == current_episode.serial_id,
-                    Episode.season > current_episode.season
-                ).scalar_subquery()
-            )
-        )
-    ).order_by(Episode.season, Episode.episode) \
-     .first()
-    return next_episode
+        Episode.file_id,
+    ).filter(Episode.serial_id == serial_id) \
+     .order_by(Episode.season, Episode.episode, Episode.id) \
+     .all()
 
 
-def get_serials_rating(db: Session, limit=10, page=1):
-    offset = limit * (page - 1)
+def get_serials_rating(db: Session, limit=10, page=1, cursor=None):
+    """
+    Сериалы по убыванию числа зрителей из таблицы serial_popularity,
+    которую ведет insert_episode_view_record (см. get_keyset_page).
+    """
     query = db.query(
         Serial.name_rus,
         Serial.name_eng,
-        func.count(distinct(EpisodeViewRecord.user_id)).label('users'),
-        Episode.serial_id
-    ).select_from(EpisodeViewRecord)\
-     .outerjoin(Episode, EpisodeViewRecord.episode_id == Episode.id)\
-     .outerjoin(Serial, Episode.serial_id == Serial.id)\
-     .group_by(Episode.serial_id, Serial.name_rus, Serial.name_eng)\
-     .order_by(func.count(distinct(EpisodeViewRecord.user_id)).desc())
+        SerialPopularity.users,
+        SerialPopularity.serial_id
+    ).join(Serial, Serial.id == SerialPopularity.serial_id)
+    total = db.query(func.count(SerialPopularity.serial_id)).scalar()
+
+    rows, page_keys = get_keyset_page(
+        query, [SerialPopularity.users, SerialPopularity.serial_id],
+        limit, page, total, cursor)
+    return rows, total, page_keys
 
-    return query.limit(limit).offset(offset).all(), query.count()
+
+def rebuild_serial_popularity(db: Session):
+    """
+    Пересчитывает serial_viewers и serial_popularity по всей истории
+    просмотров. Возвращает количество сериалов в рейтинге.
+    """
+    db.query(SerialPopularity).delete(synchronize_session=False)
+    db.query(SerialViewer).delete(synchronize_session=False)
+    viewers = db.query(
+        EpisodeViewRecord.user_id,
+        Episode.serial_id,
+    ).join(Episode, EpisodeViewRecord.episode_id == Episode.id)\
+     .filter(EpisodeViewRecord.user_id.is_not(None))\
+     .distinct()
+    db.execute(
+        insert(SerialViewer).from_select(['user_id', 'serial_id'], viewers)
+    )
+    popularity = db.query(
+        SerialViewer.serial_id,
+        func.count(SerialViewer.user_id),
+    ).group_by(SerialViewer.serial_id)
+    db.execute(
+        insert(SerialPopularity).from_select(['serial_id', 'users'],
+                                             popularity)
+    )
+    return db.query(func.count(SerialPopularity.serial_id)).scalar()
+
+
+def get_unfilled_aggregates(db: Session) -> list:
+    """
+    Функции пересчета агрегатных таблиц, которые пусты при непустой
+    истории просмотров, например после первого развертывания с ними.
+    """
+    if db.query(EpisodeViewRecord.user_id).first() is None:
+        return []
+    return [rebuild for model, rebuild in (
+        (SerialPopularity, rebuild_serial_popularity),
+        (ViewHistoryGroup, rebuild_view_history_groups),
+        (WatchedEpisodes, rebuild_watched_episodes),
+    ) if db.query(model).first() is None]
 
 
 def ignore_kp_episode(db: Session, kp_episode_id: int):
@@ -298,28 +452,48 @@ def ignore_kp_episode(db: Session, kp_episode_id: int):
     ).one_or_none()
 
 
-def add_all_episodes_from_kp_serial(db, serial_id: int) -> list[Episode]:
-    kp_episodes = db.query(KPEpisode).join(
-        KPSerial, KPSerial.kp_id == KPEpisode.kp_serial_id
-    ).join(
-        Serial, Serial.kp_id == KPSerial.kp_id
-    ).outerjoin(
-        Episode,
-        (Episode.serial_id == Serial.id) &
-        (Episode.season == KPEpisode.season) &
-        (Episode.episode == KPEpisode.episode)
-    ).filter(
-        Serial.id == serial_id,
-        ~KPEpisode.ignore,
-        Episode.id.is_(None),  # Нет существующего эпизода
-    ).all()
-
-    created_episodes = []
-    for kp_episode in kp_episodes:
-        episode = add_episode_from_kp_episode(db, kp_episode.id)
-        created_episodes.append(episode)
+def add_all_episodes_from_kp_serial(db, serial_id: int) -> list[int]:
+    """
+    Добавляет в Episode все неигнорируемые эпизоды kinopoisk.ru, которых
+    еще нет у сериала, одним INSERT ... SELECT.
 
-    return created_episodes
+    Returns:
+        list: id созданных эпизодов
+    """
+    serial_id = int(serial_id)
+    # Название как в add_episode_from_kp_episode: русское, если оно есть
+    episode_name = case(
+        (KPEpisode.name_rus != '',
+         KPEpisode.name_rus + ' (' + KPEpisode.name_eng + ')'),
+        else_=KPEpisode.name_eng,
+    )
+    kp_episodes = db.query(
+        Serial.id,
+        KPEpisode.season,
+        KPEpisode.episode,
+        episode_name,
+    ).join(
+        Serial, Serial.kp_id == KPEpisode.kp_serial_id
+    ).filter(*get_missing_kp_episode_conditions(db, serial_id))
+    # Новые эпизоды ищутся по своим (season, episode), а не по id больше
+    # максимального, который захватил бы эпизоды параллельных вставок
+    missing = {(row.season, row.episode) for row in kp_episodes}
+    if not missing:
+        return []
+    result = db.execute(
+        insert(Episode).from_select(
+            ['serial_id', 'season', 'episode', 'name'], kp_episodes)
+    )
+    if not result.rowcount:
+        return []
+    mark_serial_changed(db, serial_id)
+    episode_ids = [episode_id for episode_id, in db.query(Episode.id).filter(
+        Episode.serial_id == serial_id,
+        tuple_(Episode.season, Episode.episode).in_(missing),
+    ).order_by(Episode.id)]
+    for episode_id in episode_ids:
+        mark_episode_changed(db, episode_id)
+    return episode_ids
 
 
 def add_episode_from_kp_episode(db: Session, kp_episode_id: int) -> Episode:
@@ -379,58 +553,311 @@ def add_episode_from_kp_episode(db: Session, kp_episode_id: int) -> Episode:
 
     db.add(new_episode)
     db.flush()  # Чтобы получить id нового эпизода
+    mark_serial_changed(db, serial.id)
+    mark_episode_changed(db, new_episode.id)
 
     return new_episode
 
 
-def insert_kp_serial(db: Session, serial, episodes):
-    serial_id = serial['kinopoiskId']
-    kp_serial = db.get(KPSerial, serial_id)
-    if kp_serial:
-        db.delete(kp_serial)
-    new_kp_serial = KPSerial(
-            kp_id=serial_id,
-            name_rus=serial['nameRu'],
-            name_eng=serial['nameOriginal'] or serial['nameEn'] or '',
-            descr=serial['description'],
-            poster=serial['posterUrlPreview'],
-            imdb=serial['imdbId'],
-        )
+def insert_kp_serial(db: Session, serial, episodes) -> Counter:
+    """
+    Сохраняет сериал kinopoisk.ru и его эпизоды.
+    Добавляются только новые эпизоды, у известных обновляются изменившиеся
+    названия, отметки ignore сохраняются. Эпизоды, которых больше нет
+    в ответе kinopoisk.ru, не удаляются.
+
+    Returns:
+        Counter: число эпизодов inserted, updated и unchanged
+    """
+    kp_id = serial['kinopoiskId']
+    values = {
+        'name_rus': serial['nameRu'],
+        'name_eng': serial['nameOriginal'] or serial['nameEn'] or '',
+        'descr': serial['description'],
+        'poster': serial['posterUrlPreview'],
+        'imdb': serial['imdbId'],
+    }
+    kp_serial = db.get(KPSerial, kp_id)
+    if kp_serial is None:
+        db.add(KPSerial(kp_id=kp_id, **values))
+        # The episodes below are inserted by a Core statement
+        db.flush()
+        serial_changed = True
+    else:
+        serial_changed = any(getattr(kp_serial, name) != value
+                             for name, value in values.items())
+        for name, value in values.items():
+            setattr(kp_serial, name, value)
+
+    existing = {
+        (row.season, row.episode): (row.id, (row.name_rus, row.name_eng))
+        for row in db.query(KPEpisode.id, KPEpisode.season, KPEpisode.episode,
+                            KPEpisode.name_rus, KPEpisode.name_eng)
+        .filter(KPEpisode.kp_serial_id == kp_id)
+    }
+    new_episodes = {}
+    changed_episodes = []
+    counts = Counter(inserted=0, updated=0, unchanged=0)
     for season in episodes.get('items', []):
         for episode in season['episodes']:
-            # logging.error(episode)
-            new_kp_serial.episodes.append(
-                KPEpisode(
-                    season=episode['seasonNumber'],
-                    episode=episode['episodeNumber'],
-                    name_rus=episode['nameRu'] or '',
-                    name_eng=episode['nameEn'] or '',
-                )
-            )
+            key = (episode['seasonNumber'], episode['episodeNumber'])
+            names = (episode['nameRu'] or '', episode['nameEn'] or '')
+            episode_id, old_names = existing.get(key, (None, None))
+            if episode_id is None:
+                new_episodes[key] = {
+                    'kp_serial_id': kp_id,
+                    'season': key[0],
+                    'episode': key[1],
+                    'name_rus': names[0],
+                    'name_eng': names[1],
+                    'ignore': False,
+                }
+            elif old_names != names:
+                changed_episodes.append({'id': episode_id,
+                                         'name_rus': names[0],
+                                         'name_eng': names[1]})
+                # Repeated episodes in the response are updated once
+                existing[key] = (episode_id, names)
+            else:
+                counts['unchanged'] += 1
+    if new_episodes:
+        db.execute(insert(KPEpisode), list(new_episodes.values()))
+    if changed_episodes:
+        db.bulk_update_mappings(KPEpisode, changed_episodes)
+    counts['inserted'] = len(new_episodes)
+    counts['updated'] = len(changed_episodes)
+
+    if serial_changed or new_episodes or changed_episodes:
+        linked_serial_id = db.query(Serial.id).filter(
+            Serial.kp_id == str(kp_id)).scalar()
+        if linked_serial_id:
+            mark_serial_changed(db, linked_serial_id)
+    return counts
+
+
+def insert_kp_serials(db: Session, serials: list[tuple]) -> Counter:
+    """
+    Сохраняет пачку сериалов kinopoisk.ru (пары serial, episodes) в одной
+    транзакции.
 
-    db.add(new_kp_serial)
+    Returns:
+        Counter: суммарное число эпизодов inserted, updated и unchanged
+    """
+    counts = Counter(inserted=0, updated=0, unchanged=0)
+    for serial, episodes in serials:
+        counts.update(insert_kp_serial(db, serial, episodes))
+    return counts
 
 
 def insert_episode_view_record(db: Session, user_id: int, episode_id: int):
-    db.add(
-        EpisodeViewRecord(
-            user_id=user_id,
-            episode_id=episode_id,
-            created_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+    insert_episode_view_records(db, [{
+        'user_id': int(user_id),
+        'episode_id': int(episode_id),
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
+    }])
+
+
+def insert_episode_view_records(db: Session, records: list[dict]):
+    """
+    Сохраняет пачку просмотров (словари user_id, episode_id, created_at)
+    одним INSERT и обновляет по ним рейтинг сериалов, группы истории и
+    отметки просмотренных эпизодов.
+    """
+    db.execute(insert(EpisodeViewRecord), records)
+
+    episodes = {
+        episode.id: episode
+        for episode in db.query(
+            Episode.id,
+            Episode.serial_id,
+            Episode.season,
+            Episode.episode,
+        ).filter(
+            Episode.id.in_({record['episode_id'] for record in records})
         )
-    )
+    }
+    views = [
+        (record['user_id'], episodes[record['episode_id']],
+         record['created_at'])
+        for record in records if record['episode_id'] in episodes
+    ]
+    if not views:
+        return
+    update_serial_popularity(
+        db, {(user_id, episode.serial_id) for user_id, episode, _ in views})
+    update_view_history_groups(
+        db, [(user_id, episode.serial_id, created_at)
+             for user_id, episode, created_at in views])
+    update_watched_episodes(
+        db, {(user_id, episode.serial_id, episode.season, episode.episode)
+             for user_id, episode, _ in views})
+
+
+def update_serial_popularity(db: Session, viewers: set[tuple]):
+    """
+    Увеличивает рейтинг сериалов для новых пар (user_id, serial_id):
+    одним UPDATE для сериалов в рейтинге и одним INSERT для новых.
+    Пересчет rebuild_serial_popularity идет при остановленной записи
+    просмотров (см. ViewRecordWriter.paused).
+    """
+    known_viewers = set(db.query(
+        SerialViewer.user_id,
+        SerialViewer.serial_id,
+    ).filter(
+        SerialViewer.user_id.in_({user_id for user_id, _ in viewers}),
+        SerialViewer.serial_id.in_({serial_id for _, serial_id in viewers}),
+    ).all())
+    new_viewers = viewers - known_viewers
+    if not new_viewers:
+        return
+    db.execute(insert(SerialViewer), [
+        {'user_id': user_id, 'serial_id': serial_id}
+        for user_id, serial_id in new_viewers
+    ])
+    new_users = Counter(serial_id for _, serial_id in new_viewers)
+    rated_serials = {serial_id for serial_id, in db.query(
+        SerialPopularity.serial_id
+    ).filter(SerialPopularity.serial_id.in_(new_users))}
+    if rated_serials:
+        db.query(SerialPopularity).filter(
+            SerialPopularity.serial_id.in_(rated_serials)
+        ).update({SerialPopularity.users: SerialPopularity.users + case(
+            {serial_id: new_users[serial_id] for serial_id in rated_serials},
+            value=SerialPopularity.serial_id)}, synchronize_session=False)
+    unrated_serials = new_users.keys() - rated_serials
+    if unrated_serials:
+        db.execute(insert(SerialPopularity), [
+            {'serial_id': serial_id, 'users': new_users[serial_id]}
+            for serial_id in unrated_serials
+        ])
+
+
+def update_view_history_groups(db: Session, views: list[tuple]):
+    """
+    Продлевает последнюю группу истории пользователя просмотрами того же
+    сериала или открывает новую группу. views - (user_id, serial_id,
+    created_at) в порядке просмотра. Пишет одним UPDATE и одним INSERT.
+    """
+    latest_ids = db.query(func.max(ViewHistoryGroup.id)).filter(
+        ViewHistoryGroup.user_id.in_({user_id for user_id, _, _ in views})
+    ).group_by(ViewHistoryGroup.user_id)
+    latest_groups = {
+        group.user_id: {'id': group.id, 'serial_id': group.serial_id,
+                        'views': 0}
+        for group in db.query(
+            ViewHistoryGroup.id,
+            ViewHistoryGroup.user_id,
+            ViewHistoryGroup.serial_id,
+        ).filter(ViewHistoryGroup.id.in_(latest_ids))
+    }
+    stored_groups = list(latest_groups.values())
+    new_groups = []
+    for user_id, serial_id, created_at in views:
+        group = latest_groups.get(user_id)
+        if group is not None and group['serial_id'] == serial_id:
+            group['views'] += 1
+            group['last_viewed_at'] = created_at
+            continue
+        group = {
+            'user_id': user_id,
+            'serial_id': serial_id,
+            'views': 1,
+            'first_viewed_at': created_at,
+            'last_viewed_at': created_at,
+        }
+        latest_groups[user_id] = group
+        new_groups.append(group)
+
+    extended_groups = [group for group in stored_groups if group['views']]
+    if extended_groups:
+        db.query(ViewHistoryGroup).filter(
+            ViewHistoryGroup.id.in_(
+                [group['id'] for group in extended_groups])
+        ).update({
+            ViewHistoryGroup.views: ViewHistoryGroup.views + case(
+                {group['id']: group['views'] for group in extended_groups},
+                value=ViewHistoryGroup.id),
+            ViewHistoryGroup.last_viewed_at: case(
+                {group['id']: group['last_viewed_at']
+                 for group in extended_groups},
+                value=ViewHistoryGroup.id),
+        }, synchronize_session=False)
+    if new_groups:
+        # Порядок вставки сохраняет рост id вместе с last_viewed_at
+        db.execute(insert(ViewHistoryGroup), new_groups)
+
+
+def update_watched_episodes(db: Session, watched: set[tuple]):
+    """
+    Отмечает эпизоды (user_id, serial_id, season, episode) в битовых
+    картах watched_episodes
+    """
+    bitmaps = {
+        (row.user_id, row.serial_id, row.season): row
+        for row in db.query(WatchedEpisodes).filter(
+            WatchedEpisodes.user_id.in_({key[0] for key in watched}),
+            WatchedEpisodes.serial_id.in_({key[1] for key in watched}),
+        )
+    }
+    for user_id, serial_id, season, episode in watched:
+        row = bitmaps.get((user_id, serial_id, season))
+        if row is None:
+            row = WatchedEpisodes(user_id=user_id, serial_id=serial_id,
+                                  season=season, bitmap=b'')
+            bitmaps[(user_id, serial_id, season)] = row
+            db.add(row)
+        row.bitmap = set_bit(row.bitmap, episode)
+
+
+def rebuild_watched_episodes(db: Session, chunk_size: int = 1000):
+    """
+    Пересчитывает watched_episodes по всей истории просмотров,
+    по chunk_size пользователей за запрос (см. get_viewer_ranges).
+    Возвращает количество битовых карт.
+    """
+    db.query(WatchedEpisodes).delete(synchronize_session=False)
+    total = 0
+    for first_user_id, last_user_id in get_viewer_ranges(db, chunk_size):
+        watched = db.query(
+            EpisodeViewRecord.user_id,
+            Episode.serial_id,
+            Episode.season,
+            Episode.episode,
+        ).join(Episode, EpisodeViewRecord.episode_id == Episode.id) \
+         .filter(EpisodeViewRecord.user_id.between(first_user_id,
+                                                   last_user_id)) \
+         .distinct() \
+         .order_by(EpisodeViewRecord.user_id, Episode.serial_id,
+                   Episode.season) \
+         .all()
+
+        bitmaps = []
+        for user_id, serial_id, season, episode in watched:
+            key = {'user_id': user_id, 'serial_id': serial_id,
+                   'season': season}
+            if not bitmaps or bitmaps[-1]['key'] != key:
+                bitmaps.append({'key': key, 'bitmap': b''})
+            bitmaps[-1]['bitmap'] = set_bit(bitmaps[-1]['bitmap'], episode)
+        if bitmaps:
+            db.execute(insert(WatchedEpisodes),
+                       [{**row['key'], 'bitmap': row['bitmap']}
+                        for row in bitmaps])
+        total += len(bitmaps)
+    return total
 
 
 def insert_new_episode(db: Session, serial_id: int, season: int,
                        episode: int, name: str):
-    db.add(
-        Episode(
-            serial_id=serial_id,
-            season=season,
-            episode=episode,
-            name=name,
-        )
+    new_episode = Episode(
+        serial_id=serial_id,
+        season=season,
+        episode=episode,
+        name=name,
     )
+    db.add(new_episode)
+    db.flush()
+    mark_serial_changed(db, serial_id)
+    mark_episode_changed(db, new_episode.id)
 
 
 def insert_new_user(db: Session, user):
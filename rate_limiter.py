@@ -0,0 +1,205 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+# Request priorities, lower goes first
+PRIORITY_CALLBACK = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BULK = 2
+
+# Requests answering a pressed button, they stop the client's spinner
+CALLBACK_ENDPOINTS = {'answerCallbackQuery', }
+# Requests that post new messages besides send*, the per chat limits of
+# Telegram apply to them only
+MESSAGE_ENDPOINTS = {'forwardMessage', 'forwardMessages', 'copyMessage',
+                     'copyMessages'}
+
+
+def is_new_message(endpoint):
+    return endpoint.startswith('send') and endpoint != 'sendChatAction' \
+        or endpoint in MESSAGE_ENDPOINTS
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second on average and bursts of up to
+    `capacity` requests.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    @property
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def consume(self):
+        """
+        Take a token if there is one.
+
+        Returns:
+            float: 0 if the token was taken, otherwise seconds until the
+            next token is available
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class FloodControlRateLimiter(BaseRateLimiter):
+    """
+    Keeps outgoing Bot API requests within Telegram flood limits.
+
+    Every request takes a token from the global bucket (30 per second).
+    Requests posting a new message also take one from the bucket of their
+    chat (one per second for private chats, 20 per minute for groups and
+    channels), edits, deletions and callback answers do not. Requests
+    waiting for the global bucket are served by priority: callback query
+    answers first, bulk sends (rate_limit_args={'priority': PRIORITY_BULK})
+    last.
+    On RetryAfter all requests are paused for the time Telegram asked and
+    the request is repeated up to `max_retries` times.
+    """
+    def __init__(self, global_rate=30, chat_rate=1, group_rate=20 / 60,
+                 chat_burst=3, max_retries=3, max_chat_buckets=10000):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chat_buckets = max_chat_buckets
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._global_waiters = []
+        self._global_condition = None
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+
+        self.chat_waiting = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+
+    @property
+    def queue_depth(self):
+        return len(self._global_waiters) + self.chat_waiting
+
+    async def initialize(self):
+        self._global_condition = asyncio.Condition()
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data,
+                              rate_limit_args):
+        priority = (rate_limit_args or {}).get('priority')
+        if priority is None:
+            priority = PRIORITY_CALLBACK if endpoint in CALLBACK_ENDPOINTS \
+                else PRIORITY_DEFAULT
+        chat_id = data.get('chat_id') if is_new_message(endpoint) else None
+        self.requests += 1
+        for attempt in range(self.max_retries + 1):
+            started_at = time.monotonic()
+            if chat_id is not None:
+                await self._acquire_chat(chat_id)
+            await self._acquire_global(priority)
+            self.total_wait += time.monotonic() - started_at
+            self.in_flight += 1
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                logging.warning(f'Flood control for {endpoint} in chat '
+                                f'{data.get("chat_id")}, retry in '
+                                f'{retry_after}s')
+                self.retries += 1
+                self._paused_until = max(self._paused_until,
+                                         time.monotonic() + retry_after)
+            finally:
+                self.in_flight -= 1
+
+    async def _acquire_chat(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_chat_buckets:
+                self._drop_idle_chat_buckets()
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(
+                self.group_rate if is_group else self.chat_rate,
+                self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        self.chat_waiting += 1
+        self._update_max_queue_depth()
+        try:
+            while delay := bucket.consume():
+                await asyncio.sleep(delay)
+        finally:
+            self.chat_waiting -= 1
+
+    async def _acquire_global(self, priority):
+        condition = self._global_condition
+        async with condition:
+            entry = (priority, next(self._sequence))
+            heapq.heappush(self._global_waiters, entry)
+            self._update_max_queue_depth()
+            # A more urgent request may have to overtake the current head
+            condition.notify_all()
+            try:
+                while True:
+                    if self._global_waiters[0] != entry:
+                        await condition.wait()
+                        continue
+                    delay = self._paused_until - time.monotonic()
+                    if delay <= 0:
+                        delay = self._global_bucket.consume()
+                        if not delay:
+                            return
+                    try:
+                        await asyncio.wait_for(condition.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._global_waiters.remove(entry)
+                heapq.heapify(self._global_waiters)
+                condition.notify_all()
+
+    def _drop_idle_chat_buckets(self):
+        for chat_id in [chat_id for chat_id, bucket
+                        in self._chat_buckets.items() if bucket.is_full]:
+            del self._chat_buckets[chat_id]
+
+    def _update_max_queue_depth(self):
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'retries': self.retries,
+            'avg_wait':
+                self.total_wait / self.requests if self.requests else 0.0,
+        }
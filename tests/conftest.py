@@ -0,0 +1,12 @@
+import pytest
+
+from db import Database
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Empty database with the schema of models.py"""
+    database = Database(f'sqlite:///{tmp_path / "test.db"}', pool_size=2)
+    database.init_db()
+    yield database
+    database.close()
@@ -0,0 +1,18 @@
+import asyncio
+
+from cache import CatalogCache
+from models import Episode, Serial
+
+
+def test_missing_play_payload_is_not_cached(database):
+    cache = CatalogCache(database)
+    assert asyncio.run(cache.get_play_payload(1)) is None
+    assert cache.play_payloads.stats()['size'] == 0
+    with database.session() as db:
+        db.add(Serial(id=10, name_rus='Сериал'))
+        db.add_all([Episode(id=1, serial_id=10, season=1, episode=1),
+                    Episode(id=2, serial_id=10, season=1, episode=2)])
+    payload = asyncio.run(cache.get_play_payload(1))
+    assert [row.id for row in payload.files] == [1]
+    assert payload.next_episode.id == 2
+    assert cache.play_payloads.stats()['size'] == 1
@@ -0,0 +1,67 @@
+import asyncio
+
+from catalog import BULK_SYNC_SIZE, SerialCatalog
+from models import Serial
+
+
+def add_serials(database, names):
+    with database.session() as db:
+        db.add_all([Serial(id=serial_id, name_rus=name_rus, name_eng=name_eng)
+                    for serial_id, (name_rus, name_eng) in names.items()])
+
+
+def refresh(catalog, database):
+    asyncio.run(catalog.refresh(database))
+
+
+def search_ids(catalog, text, limit=10, page=1):
+    serials, total = catalog.search(text, limit, page)
+    return [serial.id for serial in serials], total
+
+
+def test_search_by_part_of_name(database):
+    add_serials(database, {
+        1: ('Ёлки', 'Yolki'),
+        2: ('Лесные ёлки', ''),
+        3: ('Друзья', 'Friends'),
+        4: ('Друзья друзей', ''),
+    })
+    catalog = SerialCatalog()
+    refresh(catalog, database)
+    # Names starting with the text go first, ё matches е
+    assert search_ids(catalog, 'елки') == ([1, 2], 2)
+    assert search_ids(catalog, 'др') == ([3, 4], 2)
+    assert search_ids(catalog, 'д') == ([3, 4], 2)
+    assert search_ids(catalog, 'FRIEND') == ([3], 1)
+    assert search_ids(catalog, 'друзья', limit=1, page=2) == ([4], 2)
+    assert search_ids(catalog, 'нет такого') == ([], 0)
+
+
+def test_refresh_reindexes_renamed_and_removed_serials(database):
+    add_serials(database, {1: ('Друзья', 'Friends'), 2: ('Ёлки', '')})
+    catalog = SerialCatalog()
+    refresh(catalog, database)
+    with database.session() as db:
+        db.get(Serial, 1).name_rus = 'Недруги'
+        db.delete(db.get(Serial, 2))
+    add_serials(database, {3: ('Елки 2', '')})
+    refresh(catalog, database)
+    assert search_ids(catalog, 'друзья') == ([], 0)
+    assert search_ids(catalog, 'друг') == ([1], 1)
+    assert search_ids(catalog, 'елки') == ([3], 1)
+    assert [tuple(letter) for letter in catalog.alphabet_counts('RUS')] \
+        == [('Е', 1), ('Н', 1)]
+    assert sorted(serial.id for serial in catalog.sample()) == [1, 3]
+
+
+def test_bulk_sync_matches_incremental_sync(database):
+    rows = [(serial_id, f'Сериал {serial_id}', f'Serial {serial_id}')
+            for serial_id in range(1, BULK_SYNC_SIZE * 2)]
+    bulk = SerialCatalog()
+    bulk.sync(rows)
+    incremental = SerialCatalog()
+    for row in rows:
+        incremental.sync(rows[:row[0]])
+    for text in ('с', 'се', 'сериал 1', 'serial 19', '99'):
+        assert search_ids(bulk, text, limit=500) \
+            == search_ids(incremental, text, limit=500)
@@ -0,0 +1,73 @@
+import asyncio
+import threading
+
+import pytest
+
+from models import User
+
+
+def add_user(db, user_id):
+    db.add(User(id=user_id))
+    return threading.get_ident()
+
+
+def add_user_and_fail(db, user_id):
+    add_user(db, user_id)
+    db.flush()
+    raise RuntimeError('failed')
+
+
+def get_user_ids(db):
+    return [user.id for user in db.query(User).order_by(User.id)]
+
+
+def test_run_returns_result_from_worker_thread(database):
+    thread_id = asyncio.run(database.run(add_user, 1))
+    assert thread_id != threading.get_ident()
+
+
+def test_run_commits(database):
+    asyncio.run(database.run(add_user, 1))
+    with database.session() as db:
+        assert get_user_ids(db) == [1]
+
+
+def test_run_rolls_back_and_reraises(database):
+    with pytest.raises(RuntimeError):
+        asyncio.run(database.run(add_user_and_fail, 1))
+    with database.session() as db:
+        assert get_user_ids(db) == []
+
+
+def test_run_does_not_block_event_loop(database):
+    async def main():
+        started = threading.Event()
+
+        def wait_for_loop(db):
+            started.set()
+            assert loop_ticked.wait(5)
+
+        loop_ticked = threading.Event()
+        task = asyncio.create_task(database.run(wait_for_loop))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        loop_ticked.set()
+        await task
+
+    asyncio.run(main())
+
+
+def test_commit_hooks_run_after_commit_only(database):
+    changed = []
+    database.commit_hooks['changed_serials'].append(changed.append)
+
+    def mark_changed(db, fail):
+        db.info['changed_serials'] = {1}
+        if fail:
+            raise RuntimeError('failed')
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(database.run(mark_changed, True))
+    assert changed == []
+    asyncio.run(database.run(mark_changed, False))
+    assert changed == [{1}]
@@ -0,0 +1,73 @@
+import pytest
+
+from helpers import decode_cursor, encode_cursor
+from models import Serial, SerialPopularity
+from queries import get_keyset_page, get_serials_rating
+
+PAGE_LENGTH = 3
+
+
+@pytest.mark.parametrize('direction, key', [
+    ('next', (12, 345)), ('prev', (7, )), ('last', ()),
+])
+def test_cursor_round_trip(direction, key):
+    cursor = encode_cursor(direction, key)
+    assert decode_cursor(cursor, 2 if direction == 'next' else 1) \
+        == (direction, key)
+
+
+@pytest.mark.parametrize('cursor, key_length', [
+    ('n', 1), ('n12', 2), ('n1.2', 1), ('l5', 1), ('x1', 1), ('n1.a', 2),
+    ('n12.', 2), ('', 1),
+])
+def test_malformed_cursor_means_first_page(cursor, key_length):
+    assert decode_cursor(cursor, key_length) is None
+
+
+@pytest.fixture
+def rating(database):
+    """10 serials, users tie in pairs: ordered by (users, id) descending"""
+    with database.session() as db:
+        for serial_id in range(1, 11):
+            db.add(Serial(id=serial_id, name_rus=f'Сериал {serial_id}'))
+            db.add(SerialPopularity(serial_id=serial_id,
+                                    users=(serial_id + 1) // 2))
+    return database
+
+
+def get_page(database, page=1, cursor=None):
+    with database.session() as db:
+        rows, total, page_keys = get_serials_rating(
+            db, PAGE_LENGTH, page, cursor)
+        # name_rus, name_eng, users, serial_id
+        return [row[3] for row in rows], page_keys
+
+
+def test_keyset_pages_match_offset_pages(rating):
+    offset_pages = [get_page(rating, page)[0] for page in range(1, 5)]
+    assert offset_pages == [[10, 9, 8], [7, 6, 5], [4, 3, 2], [1]]
+
+    ids, page_keys = get_page(rating)
+    keyset_pages = [ids]
+    while page_keys:
+        ids, page_keys = get_page(rating, cursor=('next', page_keys[1]))
+        if ids:
+            keyset_pages.append(ids)
+    assert keyset_pages == offset_pages
+
+
+def test_prev_and_last_pages(rating):
+    _, page_keys = get_page(rating, 2)
+    assert page_keys == ((4, 7), (3, 5))
+    assert get_page(rating, cursor=('prev', page_keys[0]))[0] == [10, 9, 8]
+    assert get_page(rating, cursor=('last', ()))[0] == [1]
+
+
+def test_keyset_page_with_one_key_column(database):
+    with database.session() as db:
+        db.add_all([Serial(id=serial_id) for serial_id in range(1, 6)])
+    with database.session() as db:
+        query = db.query(Serial.name_rus)
+        rows, page_keys = get_keyset_page(query, [Serial.id], 2, 1, 5,
+                                          ('next', (4, )))
+        assert len(rows) == 2 and page_keys == ((3, ), (2, ))
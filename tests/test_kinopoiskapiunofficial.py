@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from kinopoiskapiunofficial import KinopoiskApi
+
+
+async def serve_stub(responses, requests):
+    """
+    Local Kinopoisk API stub: answers requests with (status, body) from
+    `responses` in turn, the last one is repeated.
+    """
+    async def handle(reader, writer):
+        while request_line := await reader.readline():
+            while (await reader.readline()).strip():
+                pass
+            requests.append(request_line.split()[1].decode())
+            status, body = responses[min(len(requests), len(responses)) - 1]
+            content = json.dumps(body).encode()
+            writer.write(
+                f'HTTP/1.1 {status} Stub\r\n'
+                f'Content-Type: application/json\r\n'
+                f'Content-Length: {len(content)}\r\n\r\n'.encode() + content)
+            await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+
+def get_film(responses, requests, max_retries=3):
+    async def main():
+        server = await serve_stub(responses, requests)
+        port = server.sockets[0].getsockname()[1]
+        api = KinopoiskApi('key', base_url=f'http://127.0.0.1:{port}',
+                           max_retries=max_retries, backoff=0)
+        try:
+            return await api.get_by_id(42)
+        finally:
+            await api.aclose()
+            server.close()
+
+    return asyncio.run(main())
+
+
+def test_failed_request_is_retried():
+    requests = []
+    film = get_film([(503, {}), (500, {}), (200, {'id': 42})], requests)
+    assert film == {'id': 42}
+    assert requests == ['/api/v2.2/films/42'] * 3
+
+
+def test_client_error_is_not_retried():
+    requests = []
+    with pytest.raises(httpx.HTTPStatusError):
+        get_film([(404, {}), (200, {'id': 42})], requests)
+    assert len(requests) == 1
+
+
+def test_error_is_raised_after_max_retries():
+    requests = []
+    with pytest.raises(httpx.HTTPStatusError) as error:
+        get_film([(502, {})], requests, max_retries=2)
+    assert error.value.response.status_code == 502
+    assert len(requests) == 3
+
+
+def test_connection_error_is_retried_then_raised():
+    async def main():
+        # A port nobody listens on
+        server = await asyncio.start_server(lambda *_: None, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        server.close()
+        await server.wait_closed()
+        api = KinopoiskApi('key', base_url=f'http://127.0.0.1:{port}',
+                           max_retries=2, backoff=0)
+        try:
+            await api.get_by_id(42)
+        finally:
+            await api.aclose()
+
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(main())
+
+
+def test_retry_after_header_sets_delay():
+    api = KinopoiskApi('key', backoff=100)
+    response = httpx.Response(429, headers={'Retry-After': '2'})
+    assert api._get_retry_delay(0, response) == 2
+    response = httpx.Response(429, headers={'Retry-After': '86400'})
+    assert api._get_retry_delay(0, response) == api.max_retry_after
+    assert 0 <= api._get_retry_delay(1) <= 200
+    asyncio.run(api.aclose())
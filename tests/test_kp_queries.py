@@ -0,0 +1,92 @@
+from models import Episode, KPEpisode, Serial
+from queries import add_all_episodes_from_kp_serial, insert_kp_serial
+
+KP_ID = 5
+
+
+def kp_serial(**changes):
+    return {'kinopoiskId': KP_ID, 'nameRu': 'Сериал', 'nameOriginal': None,
+            'nameEn': 'Serial', 'description': '', 'posterUrlPreview': None,
+            'imdbId': 'tt0000005', **changes}
+
+
+def kp_seasons(*episodes):
+    seasons = {}
+    for season, episode, name_rus in episodes:
+        seasons.setdefault(season, []).append({
+            'seasonNumber': season, 'episodeNumber': episode,
+            'nameRu': name_rus, 'nameEn': None})
+    return {'items': [{'number': number, 'episodes': season_episodes}
+                      for number, season_episodes in seasons.items()]}
+
+
+def get_kp_episodes(db):
+    return [tuple(row) for row in db.query(
+        KPEpisode.season, KPEpisode.episode, KPEpisode.name_rus,
+        KPEpisode.ignore,
+    ).order_by(KPEpisode.season, KPEpisode.episode)]
+
+
+def test_insert_kp_serial_inserts_updates_and_keeps_episodes(database):
+    with database.session() as db:
+        counts = insert_kp_serial(db, kp_serial(), kp_seasons(
+            (1, 1, 'Пилот'), (1, 2, 'Вторая')))
+        assert counts == {'inserted': 2, 'updated': 0, 'unchanged': 0}
+        db.query(KPEpisode).filter(KPEpisode.episode == 2) \
+            .update({KPEpisode.ignore: True})
+        db.add(Serial(id=1, kp_id=str(KP_ID)))
+    with database.session() as db:
+        # Renamed, repeated, new and missing episodes
+        counts = insert_kp_serial(db, kp_serial(), kp_seasons(
+            (1, 2, 'Вторая серия'), (1, 2, 'Вторая серия'), (2, 1, 'Новая')))
+        assert counts == {'inserted': 1, 'updated': 1, 'unchanged': 1}
+        assert db.info['changed_serials'] == {1}
+    with database.session() as db:
+        assert get_kp_episodes(db) == [
+            (1, 1, 'Пилот', False),
+            (1, 2, 'Вторая серия', True),
+            (2, 1, 'Новая', False),
+        ]
+
+
+def test_insert_kp_serial_without_changes(database):
+    episodes = kp_seasons((1, 1, 'Пилот'))
+    with database.session() as db:
+        insert_kp_serial(db, kp_serial(), episodes)
+        db.add(Serial(id=1, kp_id=str(KP_ID)))
+    with database.session() as db:
+        counts = insert_kp_serial(db, kp_serial(), episodes)
+        assert counts == {'inserted': 0, 'updated': 0, 'unchanged': 1}
+        assert 'changed_serials' not in db.info
+        insert_kp_serial(db, kp_serial(nameRu='Другое'), episodes)
+        assert db.info['changed_serials'] == {1}
+
+
+def test_add_all_episodes_returns_ids_of_inserted_episodes(database):
+    with database.session() as db:
+        insert_kp_serial(db, kp_serial(), kp_seasons(
+            (1, 1, 'Пилот'), (1, 2, 'Вторая'), (1, 3, 'Третья'),
+            (2, 1, '')))
+        insert_kp_serial(db, kp_serial(kinopoiskId=6, imdbId='tt0000006'),
+                         kp_seasons((1, 2, 'Чужая')))
+        db.query(KPEpisode).filter(KPEpisode.name_rus == 'Третья') \
+            .update({KPEpisode.ignore: True})
+        db.add_all([
+            Serial(id=1, kp_id=str(KP_ID)),
+            Serial(id=2, kp_id='6'),
+            # Already added, and an episode of another serial
+            Episode(id=10, serial_id=1, season=1, episode=1, name='Пилот'),
+            Episode(id=11, serial_id=2, season=1, episode=2, name='Чужая'),
+        ])
+    with database.session() as db:
+        episode_ids = add_all_episodes_from_kp_serial(db, 1)
+        assert db.info['changed_episodes'] == set(episode_ids)
+    with database.session() as db:
+        episodes = db.query(Episode).filter(Episode.id.in_(episode_ids)) \
+            .order_by(Episode.season, Episode.episode).all()
+        assert [(episode.serial_id, episode.season, episode.episode,
+                 episode.name) for episode in episodes] == [
+            (1, 1, 2, 'Вторая ()'),
+            (1, 2, 1, ''),
+        ]
+        assert add_all_episodes_from_kp_serial(db, 1) == []
@@ -0,0 +1,58 @@
+from sqlalchemy import insert
+
+from models import (Episode, EpisodeViewRecord, SerialPopularity,
+                    ViewHistoryGroup)
+from queries import (rebuild_serial_popularity, update_serial_popularity,
+                     update_view_history_groups)
+
+
+def get_history_groups(db):
+    return [tuple(row) for row in db.query(
+        ViewHistoryGroup.user_id, ViewHistoryGroup.serial_id,
+        ViewHistoryGroup.views, ViewHistoryGroup.first_viewed_at,
+        ViewHistoryGroup.last_viewed_at,
+    ).order_by(ViewHistoryGroup.id)]
+
+
+def test_history_groups_are_extended_or_opened(database):
+    with database.session() as db:
+        update_view_history_groups(db, [(1, 10, 't1'), (2, 20, 't1')])
+    with database.session() as db:
+        update_view_history_groups(db, [
+            (1, 10, 't2'), (1, 10, 't3'), (2, 30, 't2'), (1, 11, 't4'),
+            (1, 11, 't5'), (3, 10, 't5'),
+        ])
+        assert get_history_groups(db) == [
+            (1, 10, 3, 't1', 't3'),
+            (2, 20, 1, 't1', 't1'),
+            (2, 30, 1, 't2', 't2'),
+            (1, 11, 2, 't4', 't5'),
+            (3, 10, 1, 't5', 't5'),
+        ]
+
+
+def get_popularity(db):
+    return dict(db.query(SerialPopularity.serial_id, SerialPopularity.users))
+
+
+def test_serial_popularity_counts_new_viewers_once(database):
+    with database.session() as db:
+        update_serial_popularity(db, {(1, 10), (2, 10), (1, 20)})
+    with database.session() as db:
+        update_serial_popularity(db, {(1, 10), (3, 10), (3, 30)})
+        assert get_popularity(db) == {10: 3, 20: 1, 30: 1}
+
+
+def test_rebuild_serial_popularity_skips_anonymous_views(database):
+    with database.session() as db:
+        db.add_all([Episode(id=1, serial_id=10, season=1, episode=1),
+                    Episode(id=2, serial_id=20, season=1, episode=1)])
+        db.execute(insert(EpisodeViewRecord), [
+            {'user_id': 1, 'episode_id': 1, 'created_at': 't1'},
+            {'user_id': 1, 'episode_id': 1, 'created_at': 't2'},
+            {'user_id': 2, 'episode_id': 1, 'created_at': 't3'},
+            {'user_id': None, 'episode_id': 2, 'created_at': 't4'},
+        ])
+    with database.session() as db:
+        assert rebuild_serial_popularity(db) == 1
+        assert get_popularity(db) == {10: 2}
@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+import rate_limiter
+from rate_limiter import (PRIORITY_BULK, FloodControlRateLimiter,
+                          TokenBucket)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_bucket_allows_burst_then_waits(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    assert [bucket.consume() for _ in range(3)] == [0, 0, 0]
+    assert bucket.consume() == pytest.approx(0.5)
+
+
+def test_bucket_refills_up_to_capacity(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    for _ in range(3):
+        bucket.consume()
+    clock[0] += 0.5
+    assert bucket.consume() == 0
+    assert not bucket.is_full
+    clock[0] += 10
+    assert bucket.is_full
+    assert bucket.tokens == 3
+
+
+def request(limiter, endpoint, chat_id=1, callback=None, **rate_limit_args):
+    async def default_callback():
+        return endpoint
+
+    return limiter.process_request(
+        callback or default_callback, (), {}, endpoint, {'chat_id': chat_id},
+        rate_limit_args)
+
+
+async def run_with_limiter(limiter, coroutine_factory):
+    await limiter.initialize()
+    started_at = time.monotonic()
+    result = await coroutine_factory()
+    return result, time.monotonic() - started_at
+
+
+def test_chat_limit_applies_to_new_messages():
+    limiter = FloodControlRateLimiter(chat_rate=10, chat_burst=1)
+    _, elapsed = asyncio.run(run_with_limiter(limiter, lambda: asyncio.gather(
+        *(request(limiter, 'sendMessage') for _ in range(4)))))
+    assert elapsed >= 0.25
+
+
+def test_chat_limit_skips_edits_and_callback_answers():
+    limiter = FloodControlRateLimiter(chat_rate=0.1, chat_burst=1)
+    endpoints = ['sendMessage', 'editMessageText', 'answerCallbackQuery',
+                 'deleteMessage', 'editMessageText']
+    result, elapsed = asyncio.run(run_with_limiter(
+        limiter, lambda: asyncio.gather(
+            *(request(limiter, endpoint) for endpoint in endpoints))))
+    assert result == endpoints
+    assert elapsed < 1
+
+
+def test_callback_answers_overtake_bulk_sends():
+    limiter = FloodControlRateLimiter(global_rate=10)
+    order = []
+
+    def recording(name):
+        async def callback():
+            order.append(name)
+        return callback
+
+    async def main():
+        # Use up the global bucket, the next token comes in 0.1s
+        await asyncio.gather(*(request(limiter, 'editMessageText')
+                               for _ in range(10)))
+        bulk = asyncio.create_task(request(
+            limiter, 'editMessageText', callback=recording('bulk'),
+            priority=PRIORITY_BULK))
+        await asyncio.sleep(0.01)
+        answer = asyncio.create_task(request(
+            limiter, 'answerCallbackQuery', callback=recording('answer')))
+        await asyncio.gather(bulk, answer)
+
+    asyncio.run(run_with_limiter(limiter, main))
+    assert order == ['answer', 'bulk']
+
+
+def test_retry_after_is_retried():
+    limiter = FloodControlRateLimiter(max_retries=3)
+    failures = [RetryAfter(0), RetryAfter(0)]
+
+    async def callback():
+        if failures:
+            raise failures.pop()
+        return 'sent'
+
+    result, _ = asyncio.run(run_with_limiter(
+        limiter, lambda: request(limiter, 'sendMessage', callback=callback)))
+    assert result == 'sent'
+    assert limiter.stats()['retries'] == 2
+
+
+def test_retry_after_is_raised_after_max_retries():
+    limiter = FloodControlRateLimiter(max_retries=1)
+    calls = []
+
+    async def callback():
+        calls.append(1)
+        raise RetryAfter(0)
+
+    with pytest.raises(RetryAfter):
+        asyncio.run(run_with_limiter(
+            limiter,
+            lambda: request(limiter, 'sendMessage', callback=callback)))
+    assert len(calls) == 2
@@ -0,0 +1,56 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+
+from update_processor import PerChatUpdateProcessor
+
+
+def make_update(update_id, chat_id):
+    user = User(chat_id, 'User', False)
+    message = Message(update_id, datetime.now(), Chat(chat_id, 'private'),
+                      from_user=user, text='/history')
+    return Update(update_id, message=message)
+
+
+async def process(processor, updates, handle):
+    await processor.initialize()
+    await asyncio.gather(*(processor.process_update(update, handle(update))
+                           for update in updates))
+
+
+def run(updates, max_concurrent_updates=8):
+    processor = PerChatUpdateProcessor(max_concurrent_updates)
+    events = []
+
+    async def handle(update):
+        events.append(('start', update.update_id))
+        await asyncio.sleep(0.05)
+        events.append(('end', update.update_id))
+
+    asyncio.run(process(processor, updates, handle))
+    return events, processor
+
+
+def test_updates_of_different_chats_overlap():
+    events, _ = run([make_update(1, 10), make_update(2, 20)])
+    assert events[:2] == [('start', 1), ('start', 2)]
+
+
+def test_updates_of_one_chat_run_in_order():
+    events, processor = run([make_update(1, 10), make_update(2, 10),
+                             make_update(3, 10)])
+    assert events == [('start', 1), ('end', 1), ('start', 2), ('end', 2),
+                      ('start', 3), ('end', 3)]
+    assert processor._locks == {}
+
+
+def test_concurrency_is_bounded():
+    events, _ = run([make_update(i, i) for i in range(1, 4)],
+                    max_concurrent_updates=2)
+    assert events[:3] == [('start', 1), ('start', 2), ('end', 1)]
+
+
+def test_updates_without_chat_are_not_serialized():
+    events, _ = run([Update(1), Update(2)])
+    assert events[:2] == [('start', 1), ('start', 2)]
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+from models import EpisodeViewRecord
+from write_behind import ViewRecordWriter
+
+
+class FlakyDatabase:
+    """Fails the first `failures` calls and every call with a bad record"""
+    def __init__(self, database, failures=0, bad_episode_id=None):
+        self.database = database
+        self.failures = failures
+        self.bad_episode_id = bad_episode_id
+        self.calls = 0
+
+    async def run(self, func, records):
+        self.calls += 1
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('Lost connection')
+        if any(record['episode_id'] == self.bad_episode_id
+               for record in records):
+            raise RuntimeError('Foreign key violation')
+        return await self.database.run(func, records)
+
+
+def get_view_records(database):
+    with database.session() as db:
+        return sorted(db.query(EpisodeViewRecord.user_id,
+                               EpisodeViewRecord.episode_id))
+
+
+def add_views(writer, count):
+    for user_id in range(1, count + 1):
+        writer.add(user_id, 100 + user_id)
+
+
+def test_flush_writes_queued_records_in_one_call(database):
+    flaky = FlakyDatabase(database)
+    writer = ViewRecordWriter(flaky)
+    add_views(writer, 5)
+    asyncio.run(writer.flush())
+    assert flaky.calls == 1
+    assert get_view_records(database) == [(i, 100 + i) for i in range(1, 6)]
+    assert writer.stats()['flushed_records'] == 5
+    assert writer.queue_depth == 0
+
+
+def test_failed_flush_keeps_records_and_raises(database):
+    writer = ViewRecordWriter(FlakyDatabase(database, failures=1))
+    add_views(writer, 5)
+    with pytest.raises(RuntimeError):
+        asyncio.run(writer.flush())
+    assert writer.queue_depth == 5
+    asyncio.run(writer.flush())
+    assert len(get_view_records(database)) == 5
+
+
+def test_bad_record_is_dropped_after_max_retries(database):
+    writer = ViewRecordWriter(FlakyDatabase(database, bad_episode_id=103),
+                              max_retries=2)
+    add_views(writer, 5)
+    with pytest.raises(RuntimeError):
+        asyncio.run(writer.flush())
+    asyncio.run(writer.flush())
+    assert [episode_id for _, episode_id in get_view_records(database)] \
+        == [101, 102, 104, 105]
+    assert writer.stats()['dropped_records'] == 1
+    assert writer.queue_depth == 0
+
+
+def test_close_retries_transient_errors(database):
+    writer = ViewRecordWriter(FlakyDatabase(database, failures=1),
+                              flush_interval=0)
+    add_views(writer, 5)
+    asyncio.run(writer.close())
+    assert len(get_view_records(database)) == 5
+
+
+def test_close_does_not_raise_while_database_fails(database):
+    flaky = FlakyDatabase(database, failures=100)
+    writer = ViewRecordWriter(flaky, flush_interval=0, max_retries=3)
+    add_views(writer, 2)
+    asyncio.run(writer.close())
+    # 3 batch attempts, then one per record
+    assert flaky.calls == 5
+    assert writer.stats()['dropped_records'] == 2
+
+
+def test_full_queue_drops_new_records(database):
+    writer = ViewRecordWriter(FlakyDatabase(database), max_queue_size=3)
+    add_views(writer, 5)
+    assert writer.queue_depth == 3
+    assert writer.stats()['dropped_records'] == 2
+
+
+def test_paused_writer_does_not_flush(database):
+    writer = ViewRecordWriter(FlakyDatabase(database))
+    add_views(writer, 2)
+
+    async def main():
+        async with writer.paused():
+            flush = asyncio.create_task(writer.flush())
+            await asyncio.sleep(0.05)
+            assert get_view_records(database) == []
+        await flush
+
+    asyncio.run(main())
+    assert len(get_view_records(database)) == 2
@@ -0,0 +1,50 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes up to `max_concurrent_updates` updates concurrently, but
+    the updates of one user in one chat one by one and in order.
+    ConversationHandler keeps its state per (chat, user) and relies on
+    the updates of a conversation being processed sequentially, so a slow
+    handler of one user no longer delays the others while conversations
+    stay consistent.
+    """
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # Conversation key -> [lock, number of updates holding or waiting]
+        self._locks = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        key = self.get_conversation_key(update)
+        if key is None:
+            await coroutine
+            return
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    @staticmethod
+    def get_conversation_key(update):
+        """(chat id, user id) as in ConversationHandler, None for others"""
+        if not isinstance(update, Update):
+            return None
+        chat, user = update.effective_chat, update.effective_user
+        if chat is None and user is None:
+            return None
+        return (chat and chat.id, user and user.id)
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from queries import insert_episode_view_records
+
+
+class ViewRecordWriter:
+    """
+    Write-behind queue for episode view records.
+    Plays are only appended to memory; a background task writes them with
+    one bulk INSERT when `batch_size` records are queued or every
+    `flush_interval` seconds. `close` flushes whatever is left and does
+    not raise.
+    A batch that fails `max_retries` times in a row is inserted record by
+    record and the records that still fail are dropped. At most
+    `max_queue_size` records are queued, newer plays are dropped while the
+    queue is full.
+    """
+    def __init__(self, database, batch_size=100, flush_interval=0.5,
+                 max_retries=3, max_queue_size=10000):
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.max_queue_size = max_queue_size
+        self._records = []
+        # Failed flushes in a row of the records at the head of the queue
+        self._retries = 0
+        self._batch_ready = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.flushed_records = 0
+        self.dropped_records = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    @property
+    def queue_depth(self):
+        return len(self._records)
+
+    def add(self, user_id, episode_id):
+        if len(self._records) >= self.max_queue_size:
+            self.dropped_records += 1
+            if self.dropped_records % 1000 == 1:
+                logging.warning(
+                    f'Очередь просмотров заполнена ({self.max_queue_size}), '
+                    f'отброшено записей: {self.dropped_records}')
+            return
+        self._records.append({
+            'user_id': int(user_id),
+            'episode_id': int(episode_id),
+            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
+        })
+        if len(self._records) >= self.batch_size:
+            self._batch_ready.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Nothing retries after shutdown: a failing batch is retried here
+        # until flush falls back to inserting the records one by one
+        while True:
+            try:
+                await self.flush()
+                return
+            except Exception:
+                logging.exception('Ошибка при записи истории просмотров')
+                await asyncio.sleep(self.flush_interval)
+
+    @asynccontextmanager
+    async def paused(self):
+        """
+        Hold back flushes while the aggregate tables are rebuilt, plays
+        are queued meanwhile.
+        """
+        async with self._flush_lock:
+            yield
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._records:
+                return
+            records, self._records = self._records, []
+            started_at = time.perf_counter()
+            try:
+                await self.database.run(insert_episode_view_records, records)
+                flushed = len(records)
+            except Exception:
+                self.failed_flushes += 1
+                self._retries += 1
+                if self._retries < self.max_retries:
+                    # Keep the records for the next attempt
+                    self._records[:0] = records
+                    self.dropped_records += max(
+                        0, len(self._records) - self.max_queue_size)
+                    del self._records[self.max_queue_size:]
+                    raise
+                logging.exception(
+                    f'Пачка из {len(records)} просмотров не записана '
+                    f'{self._retries} раз подряд, записываем по одному')
+                flushed = await self._flush_one_by_one(records)
+            finally:
+                latency = time.perf_counter() - started_at
+                self.last_flush_latency = latency
+                self.max_flush_latency = max(self.max_flush_latency, latency)
+                self.total_flush_latency += latency
+            self._retries = 0
+            self.flushes += 1
+            self.flushed_records += flushed
+
+    async def _flush_one_by_one(self, records):
+        """
+        Insert records separately and drop the ones that fail.
+
+        Returns:
+            int: number of records written
+        """
+        flushed = 0
+        for record in records:
+            try:
+                await self.database.run(insert_episode_view_records,
+                                        [record])
+                flushed += 1
+            except Exception as e:
+                self.dropped_records += 1
+                logging.error(f'Просмотр {record} отброшен: {e!r}')
+        return flushed
+
+    async def _flush_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(),
+                                       self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception('Ошибка при записи истории просмотров')
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'flushed_records': self.flushed_records,
+            'dropped_records': self.dropped_records,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+            'avg_flush_latency':
+                self.total_flush_latency / self.flushes if self.flushes
+                else 0.0,
+        }